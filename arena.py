@@ -0,0 +1,594 @@
+###############################################################################
+#  Flat, array-based storage for spi ASTs.                                    #
+#                                                                             #
+#  A tree is encoded into one contiguous buffer of parallel typed arrays that #
+#  can live in a multiprocessing.shared_memory block or an mmap'd file.       #
+#  Worker processes attach to the buffer and walk or evaluate it in place,    #
+#  without unpickling an object graph.                                        #
+#                                                                             #
+###############################################################################
+"""
+Buffer layout, every section starting on an 8 byte boundary:
+
+    header        HEADER
+    kind          uint8  [nodes]      node kind, one of the K_* codes
+    a, b, c       int32  [nodes] x 3  per-kind operands, see below
+    children      int32  [children]   node indices of Compound and Block lists
+    const_tag     uint8  [consts]     C_INT, C_REAL or C_BIGINT
+    const_value   int64  [consts]     the int, the float's bits, or for a
+                                      C_BIGINT the index of its decimal string
+    name_offsets  int32  [names + 1]  start of every name in name_bytes
+    name_bytes    utf-8 text of the names
+
+    kind        a                 b                 c
+    K_PROGRAM   name              block
+    K_BLOCK     first child       declaration count compound
+    K_VARDECL   var               type
+    K_TYPE      name
+    K_COMPOUND  first child       child count
+    K_ASSIGN    var               expr
+    K_VAR       name
+    K_NOOP
+    K_BINOP     operator          left              right
+    K_NUM       constant
+    K_UNARYOP   operator          expr
+
+Shared subtrees, such as those of a hash-consed tree, are stored once.
+"""
+
+import mmap
+import struct
+from array import array
+from multiprocessing import shared_memory
+
+import spi
+from spi import Token
+
+HEADER = struct.Struct("<4sIiiiiii")
+MAGIC = b"SPIA"
+VERSION = 1
+
+(
+    K_PROGRAM,
+    K_BLOCK,
+    K_VARDECL,
+    K_TYPE,
+    K_COMPOUND,
+    K_ASSIGN,
+    K_VAR,
+    K_NOOP,
+    K_BINOP,
+    K_NUM,
+    K_UNARYOP,
+) = range(11)
+
+C_INT, C_REAL, C_BIGINT = range(3)
+
+OPERATORS = (spi.PLUS, spi.MINUS, spi.MUL, spi.INTEGER_DIV, spi.FLOAT_DIV)
+OPERATOR_CODES = {op: code for code, op in enumerate(OPERATORS)}
+OPERATOR_TOKENS = tuple(
+    Token(op, value) for op, value in zip(OPERATORS, ("+", "-", "*", "DIV", "/"))
+)
+OP_PLUS, OP_MINUS, OP_MUL, OP_INTEGER_DIV, OP_FLOAT_DIV = range(len(OPERATORS))
+
+INT64_MIN = -(2**63)
+INT64_MAX = 2**63 - 1
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def _children(node):
+    if isinstance(node, spi.Program):
+        return [node.block]
+    if isinstance(node, spi.Block):
+        return node.declarations + [node.compound_statement]
+    if isinstance(node, spi.VarDecl):
+        return [node.var_node, node.type_node]
+    if isinstance(node, spi.Compound):
+        return node.children
+    if isinstance(node, (spi.Assign, spi.BinOp)):
+        return [node.left, node.right]
+    if isinstance(node, spi.UnaryOp):
+        return [node.expr]
+    if isinstance(node, spi.ErrorNode):
+        raise ValueError("Cannot store a tree with syntax errors")
+    return []
+
+
+class ArenaBuilder(object):
+    def __init__(self):
+        self.kind = array("B")
+        self.a = array("i")
+        self.b = array("i")
+        self.c = array("i")
+        self.children = array("i")
+        self.const_tag = array("B")
+        self.const_value = array("q")
+        self.consts = {}
+        self.names = []
+        self.name_index = {}
+
+    def name(self, name):
+        if name is None:
+            return -1
+        index = self.name_index.get(name)
+        if index is None:
+            index = self.name_index[name] = len(self.names)
+            self.names.append(name)
+        return index
+
+    def constant(self, value):
+        key = (type(value), value)
+        index = self.consts.get(key)
+        if index is not None:
+            return index
+        if isinstance(value, float):
+            tag, stored = C_REAL, struct.unpack("<q", struct.pack("<d", value))[0]
+        elif INT64_MIN <= value <= INT64_MAX:
+            tag, stored = C_INT, value
+        else:
+            tag, stored = C_BIGINT, self.name(str(value))
+        index = self.consts[key] = len(self.const_tag)
+        self.const_tag.append(tag)
+        self.const_value.append(stored)
+        return index
+
+    def emit(self, kind, a=0, b=0, c=0):
+        self.kind.append(kind)
+        self.a.append(a)
+        self.b.append(b)
+        self.c.append(c)
+        return len(self.kind) - 1
+
+    def list(self, indices):
+        start = len(self.children)
+        self.children.extend(indices)
+        return start
+
+    def node(self, node, kids):
+        if isinstance(node, spi.Program):
+            return self.emit(K_PROGRAM, self.name(node.name), kids[0])
+        if isinstance(node, spi.Block):
+            start = self.list(kids[:-1])
+            return self.emit(K_BLOCK, start, len(kids) - 1, kids[-1])
+        if isinstance(node, spi.VarDecl):
+            return self.emit(K_VARDECL, kids[0], kids[1])
+        if isinstance(node, spi.Type):
+            return self.emit(K_TYPE, self.name(node.value))
+        if isinstance(node, spi.Compound):
+            return self.emit(K_COMPOUND, self.list(kids), len(kids))
+        if isinstance(node, spi.Assign):
+            return self.emit(K_ASSIGN, kids[0], kids[1])
+        if isinstance(node, spi.Var):
+            return self.emit(K_VAR, self.name(node.value))
+        if isinstance(node, spi.NoOp):
+            return self.emit(K_NOOP)
+        if isinstance(node, spi.BinOp):
+            return self.emit(K_BINOP, OPERATOR_CODES[node.op.type], kids[0], kids[1])
+        if isinstance(node, spi.Num):
+            return self.emit(K_NUM, self.constant(node.value))
+        if isinstance(node, spi.UnaryOp):
+            return self.emit(K_UNARYOP, OPERATOR_CODES[node.op.type], kids[0])
+        raise ValueError("Cannot store {} nodes".format(type(node).__name__))
+
+    def add(self, tree):
+        """Encode `tree` bottom-up and return the index of its root"""
+        index = {}
+        stack = [(tree, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if id(node) in index:
+                continue
+            kids = _children(node)
+            if not expanded:
+                stack.append((node, True))
+                stack.extend((kid, False) for kid in reversed(kids))
+                continue
+            index[id(node)] = self.node(node, [index[id(kid)] for kid in kids])
+        return index[id(tree)]
+
+    def tobytes(self, root):
+        encoded = [name.encode("utf-8") for name in self.names]
+        offsets = array("i", [0])
+        for data in encoded:
+            offsets.append(offsets[-1] + len(data))
+        header = HEADER.pack(
+            MAGIC,
+            VERSION,
+            len(self.kind),
+            len(self.children),
+            len(self.const_tag),
+            len(self.names),
+            offsets[-1],
+            root,
+        )
+        out = bytearray(header)
+        sections = (
+            self.kind,
+            self.a,
+            self.b,
+            self.c,
+            self.children,
+            self.const_tag,
+            self.const_value,
+            offsets,
+        )
+        for section in sections:
+            out.extend(bytes(_align(len(out)) - len(out)))
+            out.extend(section.tobytes())
+        out.extend(bytes(_align(len(out)) - len(out)))
+        out.extend(b"".join(encoded))
+        return bytes(out)
+
+
+def encode(tree):
+    """Return the arena encoding of `tree` as bytes"""
+    builder = ArenaBuilder()
+    return builder.tobytes(builder.add(tree))
+
+
+class ArenaView(object):
+    """
+    Read-only access to an encoded tree inside any buffer: bytes, a shared
+    memory block or an mmap. The arrays are memoryviews over that buffer;
+    only the names and constants actually used are decoded, once each.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer)
+        magic, version, nodes, children, consts, names, name_size, root = (
+            HEADER.unpack_from(self.buffer)
+        )
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not an spi AST arena")
+        self.root = root
+        offset = HEADER.size
+
+        def section(count, fmt, size):
+            nonlocal offset
+            offset = _align(offset)
+            view = self.buffer[offset : offset + count * size].cast(fmt)
+            offset += count * size
+            return view
+
+        self.kind = section(nodes, "B", 1)
+        self.a = section(nodes, "i", 4)
+        self.b = section(nodes, "i", 4)
+        self.c = section(nodes, "i", 4)
+        self.children = section(children, "i", 4)
+        self.const_tag = section(consts, "B", 1)
+        const_start = _align(offset)
+        self.const_value = section(consts, "q", 8)
+        self.const_real = self.buffer[const_start : const_start + consts * 8].cast("d")
+        self.name_offsets = section(names + 1, "i", 4)
+        offset = _align(offset)
+        self.name_bytes = self.buffer[offset : offset + name_size]
+        self._names = {}
+        self._constants = {}
+        self._nodes = {}
+
+    def __len__(self):
+        return len(self.kind)
+
+    def name(self, index):
+        if index < 0:
+            return None
+        name = self._names.get(index)
+        if name is None:
+            start, end = self.name_offsets[index], self.name_offsets[index + 1]
+            name = self._names[index] = str(self.name_bytes[start:end], "utf-8")
+        return name
+
+    def constant(self, index):
+        try:
+            return self._constants[index]
+        except KeyError:
+            pass
+        tag = self.const_tag[index]
+        if tag == C_INT:
+            value = self.const_value[index]
+        elif tag == C_REAL:
+            value = self.const_real[index]
+        else:
+            value = int(self.name(self.const_value[index]))
+        self._constants[index] = value
+        return value
+
+    def child_list(self, start, count):
+        return [self.node(i) for i in self.children[start : start + count]]
+
+    def node(self, index):
+        """Return a read-only node object that NodeVisitors can visit"""
+        node = self._nodes.get(index)
+        if node is None:
+            node = self._nodes[index] = NODE_CLASSES[self.kind[index]](self, index)
+        return node
+
+    def tree(self):
+        return self.node(self.root)
+
+    def release(self):
+        """Drop every view into the buffer so that it can be closed"""
+        self._nodes.clear()
+        for view in (
+            self.kind,
+            self.a,
+            self.b,
+            self.c,
+            self.children,
+            self.const_tag,
+            self.const_value,
+            self.const_real,
+            self.name_offsets,
+            self.name_bytes,
+            self.buffer,
+        ):
+            view.release()
+
+
+#
+# Node objects over an ArenaView. Each one subclasses the spi AST class of the
+# same name, so visitors dispatch to the same visit_ methods and isinstance
+# checks hold, but every attribute is read from the arrays.
+#
+
+
+class ArenaNode(object):
+    def __init__(self, view, index):
+        self.view = view
+        self.index = index
+
+
+class Program(ArenaNode, spi.Program):
+    name = property(lambda self: self.view.name(self.view.a[self.index]))
+    block = property(lambda self: self.view.node(self.view.b[self.index]))
+
+
+class Block(ArenaNode, spi.Block):
+    @property
+    def declarations(self):
+        return self.view.child_list(self.view.a[self.index], self.view.b[self.index])
+
+    compound_statement = property(lambda self: self.view.node(self.view.c[self.index]))
+
+
+class VarDecl(ArenaNode, spi.VarDecl):
+    var_node = property(lambda self: self.view.node(self.view.a[self.index]))
+    type_node = property(lambda self: self.view.node(self.view.b[self.index]))
+
+
+class Type(ArenaNode, spi.Type):
+    value = property(lambda self: self.view.name(self.view.a[self.index]))
+    token = property(lambda self: Token(self.value, self.value))
+
+
+class Compound(ArenaNode, spi.Compound):
+    @property
+    def children(self):
+        return self.view.child_list(self.view.a[self.index], self.view.b[self.index])
+
+
+class Assign(ArenaNode, spi.Assign):
+    token = op = Token(spi.ASSIGN, ":=")
+    left = property(lambda self: self.view.node(self.view.a[self.index]))
+    right = property(lambda self: self.view.node(self.view.b[self.index]))
+
+
+class Var(ArenaNode, spi.Var):
+    value = property(lambda self: self.view.name(self.view.a[self.index]))
+    token = property(lambda self: Token(spi.ID, self.value))
+
+
+class NoOp(ArenaNode, spi.NoOp):
+    pass
+
+
+class BinOp(ArenaNode, spi.BinOp):
+    token = op = property(lambda self: OPERATOR_TOKENS[self.view.a[self.index]])
+    left = property(lambda self: self.view.node(self.view.b[self.index]))
+    right = property(lambda self: self.view.node(self.view.c[self.index]))
+
+
+class Num(ArenaNode, spi.Num):
+    value = property(lambda self: self.view.constant(self.view.a[self.index]))
+
+    @property
+    def token(self):
+        value = self.value
+        return Token(
+            spi.REAL_CONST if isinstance(value, float) else spi.INTEGER_CONST, value
+        )
+
+
+class UnaryOp(ArenaNode, spi.UnaryOp):
+    token = op = property(lambda self: OPERATOR_TOKENS[self.view.a[self.index]])
+    expr = property(lambda self: self.view.node(self.view.b[self.index]))
+
+
+NODE_CLASSES = {
+    K_PROGRAM: Program,
+    K_BLOCK: Block,
+    K_VARDECL: VarDecl,
+    K_TYPE: Type,
+    K_COMPOUND: Compound,
+    K_ASSIGN: Assign,
+    K_VAR: Var,
+    K_NOOP: NoOp,
+    K_BINOP: BinOp,
+    K_NUM: Num,
+    K_UNARYOP: UnaryOp,
+}
+
+
+class ArenaInterpreter(object):
+    """
+    Evaluates an ArenaView directly on its arrays, with the same results as
+    spi.Interpreter. `int_bits` and `int_overflow` select the same INTEGER
+    model as they do for spi.Interpreter; overflow errors carry no position.
+    """
+
+    def __init__(self, view, int_bits=None, int_overflow="wrap"):
+        self.view = view
+        self.GLOBAL_SCOPE = {}
+        self.integers = None
+        if int_bits is not None:
+            self.integers = spi.IntegerModel(int_bits, int_overflow)
+        self.declared_types = {}
+
+    def evaluate(self, index):
+        view = self.view
+        kind, a, b, c = view.kind, view.a, view.b, view.c
+        scope = self.GLOBAL_SCOPE
+        narrow = self.integers.narrow if self.integers is not None else None
+        # Post-order walk with an explicit stack, so deep expressions cannot
+        # hit the recursion limit. A negative entry means "combine the
+        # operands of node ~entry".
+        stack = [index]
+        values = []
+        while stack:
+            i = stack.pop()
+            if i < 0:
+                i = ~i
+                if kind[i] == K_UNARYOP:
+                    if a[i] == OP_MINUS:
+                        value = -values.pop()
+                    else:
+                        value = +values.pop()
+                else:
+                    right = values.pop()
+                    left = values.pop()
+                    op = a[i]
+                    if op == OP_PLUS:
+                        value = left + right
+                    elif op == OP_MINUS:
+                        value = left - right
+                    elif op == OP_MUL:
+                        value = left * right
+                    elif op == OP_INTEGER_DIV:
+                        if narrow is not None:
+                            value = self.integers.div(left, right)
+                        else:
+                            value = left // right
+                    else:
+                        value = float(left) / float(right)
+                if narrow is not None and type(value) is int:
+                    value = narrow(value)
+                values.append(value)
+                continue
+            k = kind[i]
+            if k == K_NUM:
+                value = view.constant(a[i])
+                if narrow is not None and type(value) is int:
+                    value = narrow(value)
+                values.append(value)
+            elif k == K_VAR:
+                name = view.name(a[i])
+                value = scope.get(name)
+                if value is None:
+                    raise NameError(repr(name))
+                values.append(value)
+            elif k == K_BINOP:
+                stack.append(~i)
+                stack.append(c[i])
+                stack.append(b[i])
+            else:
+                stack.append(~i)
+                stack.append(b[i])
+        return values[0]
+
+    def execute(self, index):
+        view = self.view
+        kind, a, b, c = view.kind, view.a, view.b, view.c
+        stack = [index]
+        while stack:
+            i = stack.pop()
+            k = kind[i]
+            if k == K_ASSIGN:
+                name = view.name(a[a[i]])
+                value = self.evaluate(b[i])
+                if self.integers is not None:
+                    declared_type = self.declared_types.get(name)
+                    if declared_type == spi.REAL:
+                        value = float(value)
+                    elif declared_type == spi.INTEGER and type(value) is int:
+                        value = self.integers.narrow(value)
+                self.GLOBAL_SCOPE[name] = value
+            elif k == K_COMPOUND:
+                start = a[i]
+                stack.extend(reversed(view.children[start : start + b[i]]))
+            elif k == K_BLOCK:
+                if self.integers is not None:
+                    start = a[i]
+                    for decl in view.children[start : start + b[i]]:
+                        type_name = view.name(a[b[decl]])
+                        self.declared_types[view.name(a[a[decl]])] = type_name
+                stack.append(c[i])
+            elif k == K_PROGRAM:
+                stack.append(b[i])
+
+    def interpret(self):
+        self.execute(self.view.root)
+        return self.GLOBAL_SCOPE
+
+
+class SharedArena(object):
+    """An encoded tree in a multiprocessing.shared_memory block"""
+
+    def __init__(self, shm):
+        self.shm = shm
+        self.name = shm.name
+        self.view = ArenaView(shm.buf)
+
+    @classmethod
+    def create(cls, tree):
+        data = encode(tree)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+        shm.buf[: len(data)] = data
+        return cls(shm)
+
+    @classmethod
+    def attach(cls, name):
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13 attaching registers the block with the resource
+            # tracker too. Worker processes share their parent's tracker, so
+            # that is harmless for them.
+            shm = shared_memory.SharedMemory(name=name)
+        return cls(shm)
+
+    def close(self):
+        self.view.release()
+        self.shm.close()
+
+    def unlink(self):
+        """Free the block; call once, in the process that created it"""
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_file(tree, fname):
+    with open(fname, "wb") as f:
+        f.write(encode(tree))
+
+
+def open_file(fname):
+    """Return an ArenaView over an mmap of an encoded tree file"""
+    with open(fname, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = ArenaView(mapped)
+    view.mmap = mapped
+    return view
+
+
+def evaluate_shared(name, **options):
+    """Attach to a SharedArena by name, run it and return the final scope. For worker processes."""
+    with SharedArena.attach(name) as arena:
+        return ArenaInterpreter(arena.view, **options).interpret()
@@ -0,0 +1,644 @@
+###############################################################################
+#  Benchmarks for the Simple Pascal Interpreter.                              #
+#                                                                             #
+#  Run $ python bench.py --help to list them.                                 #
+#                                                                             #
+###############################################################################
+import argparse
+import asyncio
+import json
+import random
+import time
+
+
+def generate_program(statements, variables=20, seed=0):
+    """Return the source of a generated program with `statements` assignments"""
+    rng = random.Random(seed)
+    names = ["v{}".format(i) for i in range(variables)]
+    lines = ["PROGRAM Generated;", "VAR"]
+    lines.append("    {} : INTEGER;".format(", ".join(names)))
+    lines.append("BEGIN")
+    body = []
+    for name in names:
+        body.append("    {} := {}".format(name, rng.randint(1, 9)))
+    for _ in range(statements):
+        left, right = rng.sample(names, 2)
+        op = rng.choice(["+", "-", "DIV"])
+        body.append(
+            "    {} := {} {} {} + {} * {}".format(
+                left, right, op, rng.randint(1, 9), rng.randint(1, 9), rng.randint(1, 9)
+            )
+        )
+    lines.append(";\n".join(body))
+    lines.append("END.")
+    return "\n".join(lines) + "\n"
+
+
+def generate_repetitive_program(statements, seed=0):
+    """Return a generated program whose expressions share many subexpressions"""
+    rng = random.Random(seed)
+    inputs = ["a{}".format(i) for i in range(4)]
+    outputs = ["r{}".format(i) for i in range(16)]
+    pool = [
+        "{} * {} + {}".format(rng.choice(inputs), rng.randint(2, 9), rng.choice(inputs))
+        for _ in range(12)
+    ]
+    lines = ["PROGRAM Repetitive;", "VAR"]
+    lines.append("    {} : INTEGER;".format(", ".join(inputs + outputs)))
+    lines.append("BEGIN")
+    body = ["    {} := {}".format(name, rng.randint(1, 9)) for name in inputs]
+    for _ in range(statements):
+        if rng.random() < 0.05:
+            body.append("    {} := {}".format(rng.choice(inputs), rng.randint(1, 9)))
+            continue
+        terms = ["({})".format(rng.choice(pool)) for _ in range(4)]
+        body.append(
+            "    {} := {} DIV ({})".format(
+                rng.choice(outputs), " + ".join(terms), rng.choice(pool)
+            )
+        )
+    lines.append(";\n".join(body))
+    lines.append("END.")
+    return "\n".join(lines) + "\n"
+
+
+def generate_multiplicative_program(statements, variables=20, seed=0):
+    """Return a generated program whose INTEGER values grow without bound"""
+    rng = random.Random(seed)
+    names = ["m{}".format(i) for i in range(variables)]
+    lines = ["PROGRAM Multiplicative;", "VAR"]
+    lines.append("    {} : INTEGER;".format(", ".join(names)))
+    lines.append("BEGIN")
+    body = ["    {} := {}".format(name, rng.randint(2, 9)) for name in names]
+    for _ in range(statements):
+        left, right, other = rng.sample(names, 3)
+        body.append(
+            "    {} := {} * {} + {} * {} + {}".format(
+                left,
+                right,
+                rng.randint(2, 99),
+                other,
+                rng.randint(2, 99),
+                rng.randint(1, 99),
+            )
+        )
+    lines.append(";\n".join(body))
+    lines.append("END.")
+    return "\n".join(lines) + "\n"
+
+
+def generate_expression(leaves, seed=0):
+    """Return a random, roughly balanced expression with `leaves` numbers"""
+    rng = random.Random(seed)
+    terms = [str(rng.randint(1, 9)) for _ in range(leaves)]
+    while len(terms) > 1:
+        paired = []
+        for i in range(0, len(terms) - 1, 2):
+            paired.append("({} {} {})".format(terms[i], rng.choice("+-"), terms[i + 1]))
+        if len(terms) % 2:
+            paired.append(terms[-1])
+        terms = paired
+    return terms[0]
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def _server_client(host, port, requests, pipeline, source, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    sent = {}
+    request_id = 0
+    received = 0
+    while received < requests:
+        while request_id < requests and len(sent) < pipeline:
+            message = {"id": request_id, "mode": "program", "source": source}
+            sent[request_id] = time.perf_counter()
+            writer.write(json.dumps(message).encode("utf-8") + b"\n")
+            request_id += 1
+        await writer.drain()
+        response = json.loads(await reader.readline())
+        if not response["ok"]:
+            raise RuntimeError(response)
+        latencies.append(time.perf_counter() - sent.pop(response["id"]))
+        received += 1
+    writer.close()
+
+
+def bench_server(args):
+    """Load-test a running spi_server.py (line framing, TCP)"""
+    host, port = args.address.rsplit(":", 1)
+    source = generate_program(args.statements)
+    latencies = []
+
+    async def run():
+        await asyncio.gather(
+            *(
+                _server_client(
+                    host, int(port), args.requests, args.pipeline, source, latencies
+                )
+                for _ in range(args.connections)
+            )
+        )
+
+    start = time.perf_counter()
+    asyncio.run(run())
+    elapsed = time.perf_counter() - start
+    print("requests:    {}".format(len(latencies)))
+    print("req/s:       {:.1f}".format(len(latencies) / elapsed))
+    print("p50 latency: {:.2f} ms".format(percentile(latencies, 50) * 1000))
+    print("p99 latency: {:.2f} ms".format(percentile(latencies, 99) * 1000))
+
+
+def best_of(repeat, func):
+    """Return the fastest of `repeat` timed calls to func"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_lexer(args):
+    """Tokens per second of spi.Lexer, and the cost of computing error locations"""
+    from spi import Lexer, EOF
+
+    source = generate_program(args.statements)
+
+    def lex():
+        lexer = Lexer(source)
+        count = 0
+        while lexer.get_next_token().type != EOF:
+            count += 1
+        return count
+
+    tokens = lex()
+    elapsed = best_of(args.repeat, lex)
+    print("source:       {:.1f} KiB, {} tokens".format(len(source) / 1024.0, tokens))
+    print(
+        "lex:          {:.1f} ms, {:.3f} us/token".format(
+            elapsed * 1000, elapsed / tokens * 1e6
+        )
+    )
+
+    lexer = Lexer(source)
+    offsets = range(0, len(source), max(1, len(source) // 1000))
+    start = time.perf_counter()
+    for pos in offsets:
+        lexer.location(pos)
+    elapsed = time.perf_counter() - start
+    print(
+        "location():   {:.1f} ms for {} lookups incl. building the line index".format(
+            elapsed * 1000, len(offsets)
+        )
+    )
+
+
+def bench_recovery(args):
+    """Time to find every syntax error: one recovering parse versus fix-and-rerun"""
+    from spi import Lexer, Parser, ParserError
+
+    lines = generate_program(args.statements).splitlines()
+    rng = random.Random(1)
+    body = [i for i, line in enumerate(lines) if ":=" in line]
+    broken = {}
+    for i in rng.sample(body, args.errors):
+        broken[i] = lines[i]
+        lines[i] = lines[i].replace(":=", ":= *", 1)
+    source = "\n".join(lines)
+
+    def recovering():
+        parser = Parser(Lexer(source), recover=True)
+        parser.parse()
+        return len(parser.errors)
+
+    def fail_fast():
+        fixed = list(lines)
+        found = 0
+        while True:
+            try:
+                Parser(Lexer("\n".join(fixed))).parse()
+                return found
+            except ParserError as e:
+                found += 1
+                fixed[e.line - 1] = broken[e.line - 1]
+
+    print(
+        "errors found:  recovering {}, fail-fast {}".format(recovering(), fail_fast())
+    )
+    elapsed = best_of(args.repeat, recovering)
+    print("recovering:    {:.1f} ms".format(elapsed * 1000))
+    elapsed = best_of(1, fail_fast)
+    print("fail-fast:     {:.1f} ms".format(elapsed * 1000))
+
+
+def bench_cse(args):
+    """Node count and evaluation time with common subexpression elimination"""
+    from spi import Lexer, Parser, Interpreter
+    from optimizer import CSEInterpreter, eliminate_common_subexpressions
+
+    source = generate_repetitive_program(args.statements)
+
+    def parse():
+        return Parser(Lexer(source)).parse()
+
+    tree = parse()
+    plain = Interpreter(None)
+    elapsed_plain = best_of(args.repeat, lambda: plain.interpret(tree))
+
+    shared = parse()
+    report = eliminate_common_subexpressions(shared)
+    optimized = CSEInterpreter(None, report)
+    elapsed_cse = best_of(args.repeat, lambda: optimized.interpret(shared))
+    if plain.GLOBAL_SCOPE != optimized.GLOBAL_SCOPE:
+        raise RuntimeError("CSE changed the result")
+
+    print(report)
+    print(
+        "nodes:         {} -> {} ({:.1f}x fewer)".format(
+            report.nodes_before,
+            report.nodes_after,
+            report.nodes_before / float(report.nodes_after),
+        )
+    )
+    print(
+        "evaluate:      {:.1f} ms -> {:.1f} ms ({:.2f}x)".format(
+            elapsed_plain * 1000, elapsed_cse * 1000, elapsed_plain / elapsed_cse
+        )
+    )
+
+
+def bench_parallel_lexer(args):
+    """Scaling of parallel_lexer.ParallelLexer over 1..N worker processes"""
+    import os
+    from concurrent.futures import ProcessPoolExecutor
+    from spi import Lexer, EOF
+    from parallel_lexer import ParallelLexer
+
+    source = generate_program(args.statements)
+
+    def drain(lexer):
+        tokens = []
+        while True:
+            token = lexer.get_next_token()
+            tokens.append((token.type, token.value, token.pos, token.end))
+            if token.type == EOF:
+                return tokens
+
+    expected = drain(Lexer(source))
+    sequential = best_of(args.repeat, lambda: drain(Lexer(source)))
+    print(
+        "source:      {:.1f} MiB, {} tokens".format(
+            len(source) / 1048576.0, len(expected)
+        )
+    )
+    print("sequential:  {:.0f} ms".format(sequential * 1000))
+    for workers in range(1, (args.workers or os.cpu_count()) + 1):
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            lex = lambda: drain(
+                ParallelLexer(source, workers=workers, executor=executor)
+            )
+            if lex() != expected:
+                raise RuntimeError("parallel tokens differ from sequential")
+            elapsed = best_of(args.repeat, lex)
+        print(
+            "{:2d} workers:  {:.0f} ms ({:.2f}x)".format(
+                workers, elapsed * 1000, sequential / elapsed
+            )
+        )
+
+
+def bench_visitors(args):
+    """Per-node visit() dispatch, Interpreter.evaluate and walk() over the same large tree"""
+    from spi import Lexer, Parser, Interpreter, NodeVisitor, PLUS, iter_child_nodes
+    from genastdot import ASTVisualizer
+    from rpn_translator import RPN_Interpreter
+
+    tree = Parser(Lexer(generate_expression(args.leaves))).expr()
+
+    def recursive_walk(visitor, node):
+        """What walk() does, by recursion and with the same dispatch tables"""
+        cls = type(visitor)
+        node_class = type(node)
+        enter = cls._enter_table.get(node_class) or cls._resolve(
+            cls._enter_table, "enter_", node_class, "generic_enter"
+        )
+        enter(visitor, node)
+        results = [recursive_walk(visitor, child) for child in iter_child_nodes(node)]
+        leave = cls._leave_table.get(node_class) or cls._resolve(
+            cls._leave_table, "leave_", node_class, "generic_leave"
+        )
+        return leave(visitor, node, results)
+
+    class RecursiveEvaluator(NodeVisitor):
+        """Evaluates + and - by one visit() per node"""
+
+        def visit_BinOp(self, node):
+            if node.op.type == PLUS:
+                return self.visit(node.left) + self.visit(node.right)
+            return self.visit(node.left) - self.visit(node.right)
+
+        def visit_Num(self, node):
+            return node.value
+
+    def legacy_visit(self, node):
+        method_name = "visit_" + type(node).__name__
+        visitor = getattr(self, method_name, self.generic_visit)
+        return visitor(node)
+
+    evaluator = RecursiveEvaluator()
+    table_visit = NodeVisitor.visit
+    elapsed_table = best_of(args.repeat, lambda: evaluator.visit(tree))
+    NodeVisitor.visit = legacy_visit
+    try:
+        elapsed_legacy = best_of(args.repeat, lambda: evaluator.visit(tree))
+    finally:
+        NodeVisitor.visit = table_visit
+    interpreter = Interpreter(None)
+    assert interpreter.evaluate(tree) == evaluator.visit(tree)
+
+    print("tree:                {} nodes".format(args.leaves * 2 - 1))
+    print(
+        "visit() per node:    {:.1f} ms with dispatch tables, {:.1f} ms with getattr".format(
+            elapsed_table * 1000, elapsed_legacy * 1000
+        )
+    )
+    print(
+        "Interpreter.evaluate: {:.1f} ms".format(
+            best_of(args.repeat, lambda: interpreter.evaluate(tree)) * 1000
+        )
+    )
+    for name, make in (
+        ("ASTVisualizer:", lambda: ASTVisualizer(None)),
+        ("RPN_Interpreter:", lambda: RPN_Interpreter(tree)),
+    ):
+        print(
+            "{:<20} {:.1f} ms with walk(), {:.1f} ms recursive".format(
+                name,
+                best_of(args.repeat, lambda: make().walk(tree)) * 1000,
+                best_of(args.repeat, lambda: recursive_walk(make(), tree)) * 1000,
+            )
+        )
+
+    chain = Parser(Lexer(" + ".join(["1"] * args.leaves))).expr()
+    print(
+        "{}-deep chain walk:  {:.1f} ms (ASTVisualizer), {:.1f} ms (RPN_Interpreter)".format(
+            args.leaves,
+            best_of(1, lambda: ASTVisualizer(None).walk(chain)) * 1000,
+            best_of(1, lambda: RPN_Interpreter(chain).translate()) * 1000,
+        )
+    )
+
+
+def bench_metrics(args):
+    """Interpreter runs with and without the always-on metrics"""
+    from spi import Lexer, Parser, Interpreter
+    from metrics import SpiMetrics
+
+    text = generate_program(args.statements)
+    recorder = SpiMetrics()
+
+    def plain():
+        Interpreter(Parser(Lexer(text))).interpret()
+
+    elapsed_plain = best_of(args.repeat, plain)
+    elapsed_metrics = best_of(args.repeat, lambda: recorder.run(text))
+
+    print("program:             {} statements".format(args.statements))
+    print("plain:               {:.1f} ms".format(elapsed_plain * 1000))
+    print(
+        "with metrics:        {:.1f} ms ({:+.1f}%)".format(
+            elapsed_metrics * 1000, (elapsed_metrics / elapsed_plain - 1) * 100
+        )
+    )
+    print(
+        "per run:             {} tokens, {} nodes, {} statements".format(
+            recorder.tokens.get() // recorder.runs.get(),
+            recorder.nodes.get() // recorder.runs.get(),
+            recorder.statements.get() // recorder.runs.get(),
+        )
+    )
+
+
+def bench_integers(args):
+    """Unbounded versus fixed-width INTEGER arithmetic on a multiply-heavy program"""
+    from spi import Lexer, Parser, Interpreter
+    from arena import ArenaView, ArenaInterpreter, encode
+
+    tree = Parser(Lexer(generate_multiplicative_program(args.statements))).parse()
+    view = ArenaView(encode(tree))
+
+    print("program:             {} statements".format(args.statements))
+    for bits in (None, 64, 32, 16):
+        interpreter = Interpreter(None, int_bits=bits)
+        elapsed = best_of(args.repeat, lambda: interpreter.interpret(tree))
+        elapsed_arena = best_of(
+            args.repeat, lambda: ArenaInterpreter(view, int_bits=bits).interpret()
+        )
+        largest = max(abs(value) for value in interpreter.GLOBAL_SCOPE.values())
+        print(
+            "{:<20} {:.1f} ms, arena {:.1f} ms, largest value {} bits".format(
+                "unbounded:" if bits is None else "{}-bit wrap:".format(bits),
+                elapsed * 1000,
+                elapsed_arena * 1000,
+                largest.bit_length(),
+            )
+        )
+
+
+def bench_forkserver(args):
+    """Per-invocation latency of `python spi.py` against spi_forkclient.py"""
+    import os
+    import subprocess
+    import sys
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, "prog.pas")
+        with open(source, "w") as f:
+            f.write(generate_program(args.statements))
+        here = os.path.dirname(os.path.abspath(__file__))
+        path = os.path.join(directory, "spi.sock")
+        env = dict(os.environ, SPI_FORKSERVER=path)
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(here, "spi_forkserver.py"), "--socket", path]
+        )
+        try:
+            while not os.path.exists(path):
+                time.sleep(0.01)
+
+            def invoke(script):
+                command = [sys.executable, os.path.join(here, script), source]
+                latencies = []
+                for _ in range(args.runs):
+                    start = time.perf_counter()
+                    output = subprocess.run(
+                        command, env=env, capture_output=True
+                    ).stdout
+                    latencies.append(time.perf_counter() - start)
+                return output, latencies
+
+            cold_output, cold = invoke("spi.py")
+            fork_output, fork = invoke("spi_forkclient.py")
+        finally:
+            server.terminate()
+            server.wait()
+    if cold_output != fork_output:
+        raise RuntimeError("spi_forkclient.py printed different output")
+
+    print("program:      {} statements, {} runs".format(args.statements, args.runs))
+    for name, latencies in (("spi.py", cold), ("fork server", fork)):
+        print(
+            "{:<13} p50 {:.1f} ms, p99 {:.1f} ms".format(
+                name + ":",
+                percentile(latencies, 50) * 1000,
+                percentile(latencies, 99) * 1000,
+            )
+        )
+
+
+def bench_svg(args):
+    """Tidy-tree layout and SVG output of genastdot.SVGRenderer on a large tree"""
+    import os
+    import tempfile
+    from spi import Lexer, Parser
+    from genastdot import ASTVisualizer, SVGRenderer
+
+    class ExpressionParser(Parser):
+        def parse(self):
+            return self.expr()
+
+    sources = (
+        ("balanced", generate_expression(args.leaves)),
+        ("chain", " + ".join(["1"] * args.leaves)),
+    )
+    for name, source in sources:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "ast.svg")
+            renderer = SVGRenderer(ExpressionParser(Lexer(source)))
+            start = time.perf_counter()
+            with open(path, "w") as out:
+                renderer.gensvg(out)
+            elapsed = time.perf_counter() - start
+            size = os.path.getsize(path)
+        start = time.perf_counter()
+        ASTVisualizer(ExpressionParser(Lexer(source))).gendot()
+        elapsed_dot = time.perf_counter() - start
+        print(
+            "{:<9} {} nodes: SVG {:.2f} s ({:.1f} MiB), DOT text alone {:.2f} s".format(
+                name + ":",
+                len(renderer.labels),
+                elapsed,
+                size / 1024.0 / 1024.0,
+                elapsed_dot,
+            )
+        )
+
+
+def bench_stream(args):
+    """Peak memory and time of Interpreter.interpret against interpret_stream"""
+    import tracemalloc
+    from spi import Lexer, Parser, Interpreter
+
+    source = generate_program(args.statements)
+    scopes = []
+    for name in ("interpret", "interpret_stream"):
+        tracemalloc.start()
+        start = time.perf_counter()
+        interpreter = Interpreter(Parser(Lexer(source)))
+        getattr(interpreter, name)()
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        scopes.append(interpreter.GLOBAL_SCOPE)
+        print(
+            "{:<18} peak {:.3f} MiB, {:.2f} s (under tracemalloc)".format(
+                name + ":", peak / 1024.0 / 1024.0, elapsed
+            )
+        )
+    if scopes[0] != scopes[1]:
+        raise RuntimeError("interpret_stream gave a different GLOBAL_SCOPE")
+    print("source:            {:.1f} MiB".format(len(source) / 1024.0 / 1024.0))
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Benchmarks for the Pascal interpreter."
+    )
+    subparsers = argparser.add_subparsers(dest="benchmark", required=True)
+
+    server = subparsers.add_parser("server", help=bench_server.__doc__)
+    server.add_argument("address", metavar="HOST:PORT")
+    server.add_argument("--connections", type=int, default=8)
+    server.add_argument("--requests", type=int, default=500, help="per connection")
+    server.add_argument(
+        "--pipeline", type=int, default=16, help="requests in flight per connection"
+    )
+    server.add_argument(
+        "--statements", type=int, default=50, help="statements per program"
+    )
+    server.set_defaults(run=bench_server)
+
+    lexer = subparsers.add_parser("lexer", help=bench_lexer.__doc__)
+    lexer.add_argument("--statements", type=int, default=20000)
+    lexer.add_argument("--repeat", type=int, default=5)
+    lexer.set_defaults(run=bench_lexer)
+
+    recovery = subparsers.add_parser("recovery", help=bench_recovery.__doc__)
+    recovery.add_argument("--statements", type=int, default=20000)
+    recovery.add_argument("--errors", type=int, default=50)
+    recovery.add_argument("--repeat", type=int, default=3)
+    recovery.set_defaults(run=bench_recovery)
+
+    cse = subparsers.add_parser("cse", help=bench_cse.__doc__)
+    cse.add_argument("--statements", type=int, default=20000)
+    cse.add_argument("--repeat", type=int, default=3)
+    cse.set_defaults(run=bench_cse)
+
+    parallel_lexer = subparsers.add_parser(
+        "parallel-lexer", help=bench_parallel_lexer.__doc__
+    )
+    parallel_lexer.add_argument("--statements", type=int, default=200000)
+    parallel_lexer.add_argument(
+        "--workers", type=int, help="largest pool size (default: all cores)"
+    )
+    parallel_lexer.add_argument("--repeat", type=int, default=3)
+    parallel_lexer.set_defaults(run=bench_parallel_lexer)
+
+    visitors = subparsers.add_parser("visitors", help=bench_visitors.__doc__)
+    visitors.add_argument("--leaves", type=int, default=100000)
+    visitors.add_argument("--repeat", type=int, default=3)
+    visitors.set_defaults(run=bench_visitors)
+
+    metrics = subparsers.add_parser("metrics", help=bench_metrics.__doc__)
+    metrics.add_argument("--statements", type=int, default=20000)
+    metrics.add_argument("--repeat", type=int, default=5)
+    metrics.set_defaults(run=bench_metrics)
+
+    integers = subparsers.add_parser("integers", help=bench_integers.__doc__)
+    integers.add_argument("--statements", type=int, default=20000)
+    integers.add_argument("--repeat", type=int, default=3)
+    integers.set_defaults(run=bench_integers)
+
+    forkserver = subparsers.add_parser("forkserver", help=bench_forkserver.__doc__)
+    forkserver.add_argument("--statements", type=int, default=50)
+    forkserver.add_argument("--runs", type=int, default=100)
+    forkserver.set_defaults(run=bench_forkserver)
+
+    svg = subparsers.add_parser("svg", help=bench_svg.__doc__)
+    svg.add_argument("--leaves", type=int, default=50000)
+    svg.set_defaults(run=bench_svg)
+
+    stream = subparsers.add_parser("stream", help=bench_stream.__doc__)
+    stream.add_argument("--statements", type=int, default=50000)
+    stream.set_defaults(run=bench_stream)
+
+    args = argparser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,15 @@
 #  AST visualizer - generates a DOT file for Graphviz.                        #
 #                                                                             #
 #  To generate an image from the DOT file run $ dot -Tpng -o ast.png ast.dot  #
+#  or draw it without Graphviz with           $ python genastdot.py --svg ... #
 #                                                                             #
 ###############################################################################
 # from: https://github.com/rspivak/lsbasi/blob/master/part10/python/genastdot.py
 import argparse
 import textwrap
+from html import escape
 
-from spi import Lexer, Parser, NodeVisitor
+from spi import Lexer, Parser, NodeVisitor, iter_child_nodes
 
 
 class ASTVisualizer(NodeVisitor):
@@ -28,134 +30,274 @@ class ASTVisualizer(NodeVisitor):
         self.dot_body = []
         self.dot_footer = ["}"]
 
-    def visit_Program(self, node):
-        s = '  node{} [label="Program"]\n'.format(self.ncount)
+    def add_node(self, node, label):
+        s = '  node{} [label="{}"]\n'.format(self.ncount, label)
         self.dot_body.append(s)
         node._num = self.ncount
         self.ncount += 1
 
-        self.visit(node.block)
+    def enter_Program(self, node):
+        self.add_node(node, "Program")
 
-        s = "  node{} -> node{}\n".format(node._num, node.block._num)
-        self.dot_body.append(s)
+    def enter_Block(self, node):
+        self.add_node(node, "Block")
 
-    def visit_Block(self, node):
-        s = '  node{} [label="Block"]\n'.format(self.ncount)
-        self.dot_body.append(s)
-        node._num = self.ncount
-        self.ncount += 1
+    def enter_VarDecl(self, node):
+        self.add_node(node, "VarDecl")
 
-        for declaration in node.declarations:
-            self.visit(declaration)
-        self.visit(node.compound_statement)
+    def enter_Type(self, node):
+        self.add_node(node, node.token.value)
 
-        for decl_node in node.declarations:
-            s = "  node{} -> node{}\n".format(node._num, decl_node._num)
-            self.dot_body.append(s)
+    def enter_Num(self, node):
+        self.add_node(node, node.token.value)
 
-        s = "  node{} -> node{}\n".format(node._num, node.compound_statement._num)
-        self.dot_body.append(s)
+    def enter_BinOp(self, node):
+        self.add_node(node, node.op.value)
 
-    def visit_VarDecl(self, node):
-        s = '  node{} [label="VarDecl"]\n'.format(self.ncount)
-        self.dot_body.append(s)
-        node._num = self.ncount
-        self.ncount += 1
-
-        self.visit(node.var_node)
-        s = "  node{} -> node{}\n".format(node._num, node.var_node._num)
-        self.dot_body.append(s)
+    def enter_UnaryOp(self, node):
+        self.add_node(node, "unary {}".format(node.op.value))
 
-        self.visit(node.type_node)
-        s = "  node{} -> node{}\n".format(node._num, node.type_node._num)
-        self.dot_body.append(s)
+    def enter_Compound(self, node):
+        self.add_node(node, "Compound")
 
-    def visit_Type(self, node):
-        s = '  node{} [label="{}"]\n'.format(self.ncount, node.token.value)
-        self.dot_body.append(s)
-        node._num = self.ncount
-        self.ncount += 1
+    def enter_Assign(self, node):
+        self.add_node(node, node.op.value)
 
-    def visit_Num(self, node):
-        s = '  node{} [label="{}"]\n'.format(self.ncount, node.token.value)
-        self.dot_body.append(s)
-        node._num = self.ncount
-        self.ncount += 1
+    def enter_Var(self, node):
+        self.add_node(node, node.value)
 
-    def visit_BinOp(self, node):
-        s = '  node{} [label="{}"]\n'.format(self.ncount, node.op.value)
-        self.dot_body.append(s)
-        node._num = self.ncount
-        self.ncount += 1
+    def enter_NoOp(self, node):
+        self.add_node(node, "NoOp")
 
-        self.visit(node.left)
-        self.visit(node.right)
+    def enter_ErrorNode(self, node):
+        self.add_node(node, "Error")
 
-        for child_node in (node.left, node.right):
+    def generic_leave(self, node, results):
+        """Every node gets an edge to each of its children"""
+        for child_node in iter_child_nodes(node):
             s = "  node{} -> node{}\n".format(node._num, child_node._num)
             self.dot_body.append(s)
 
-    def visit_UnaryOp(self, node):
-        s = '  node{} [label="unary {}"]\n'.format(self.ncount, node.op.value)
-        self.dot_body.append(s)
-        node._num = self.ncount
-        self.ncount += 1
-
-        self.visit(node.expr)
-        s = "  node{} -> node{}\n".format(node._num, node.expr._num)
-        self.dot_body.append(s)
+    def gendot(self):
+        tree = self.parser.parse()
+        self.walk(tree)
+        return "".join(self.dot_header + self.dot_body + self.dot_footer)
 
-    def visit_Compound(self, node):
-        s = '  node{} [label="Compound"]\n'.format(self.ncount)
-        self.dot_body.append(s)
-        node._num = self.ncount
-        self.ncount += 1
 
-        for child in node.children:
-            self.visit(child)
-            s = "  node{} -> node{}\n".format(node._num, child._num)
-            self.dot_body.append(s)
+def tidy_layout(children, order, widths, gap=10.0):
+    """
+    Lay out a tree in linear time with the algorithm of Buchheim, Juenger and
+    Leipert, "Improving Walker's Algorithm to Run in Linear Time" (2002).
+
+    `children` lists the child numbers of every node, `order` lists all the
+    nodes in post-order and `widths` gives their widths; neighbours on a level
+    are kept `gap` apart. Both walks are iterative, so any depth works.
+    Returns the x coordinate of each node's centre and its depth.
+    """
+    count = len(children)
+    parent = [-1] * count
+    number = [0] * count
+    for v, kids in enumerate(children):
+        for i, w in enumerate(kids):
+            parent[w] = v
+            number[w] = i
+    prelim = [0.0] * count
+    mod = [0.0] * count
+    shift = [0.0] * count
+    change = [0.0] * count
+    thread = [-1] * count
+    ancestor = list(range(count))
+    default_ancestor = [-1] * count
+
+    def next_left(v):
+        kids = children[v]
+        return kids[0] if kids else thread[v]
+
+    def next_right(v):
+        kids = children[v]
+        return kids[-1] if kids else thread[v]
+
+    def distance(left, right):
+        return (widths[left] + widths[right]) / 2.0 + gap
+
+    def move_subtree(wl, wr, amount):
+        subtrees = number[wr] - number[wl]
+        change[wr] -= amount / subtrees
+        shift[wr] += amount
+        change[wl] += amount / subtrees
+        prelim[wr] += amount
+        mod[wr] += amount
+
+    def apportion(v, default):
+        p = parent[v]
+        w = children[p][number[v] - 1]
+        vir = vor = v
+        vil = w
+        vol = children[p][0]
+        sir = sor = mod[vir]
+        sil = mod[vil]
+        sol = mod[vol]
+        while next_right(vil) != -1 and next_left(vir) != -1:
+            vil = next_right(vil)
+            vir = next_left(vir)
+            vol = next_left(vol)
+            vor = next_right(vor)
+            ancestor[vor] = v
+            amount = (prelim[vil] + sil) - (prelim[vir] + sir) + distance(vil, vir)
+            if amount > 0:
+                a = ancestor[vil]
+                move_subtree(a if parent[a] == p else default, v, amount)
+                sir += amount
+                sor += amount
+            sil += mod[vil]
+            sir += mod[vir]
+            sol += mod[vol]
+            sor += mod[vor]
+        if next_right(vil) != -1 and next_right(vor) == -1:
+            thread[vor] = next_right(vil)
+            mod[vor] += sil - sor
+        else:
+            if next_left(vir) != -1 and next_left(vol) == -1:
+                thread[vol] = next_left(vir)
+                mod[vol] += sir - sol
+            default = v
+        return default
+
+    # First walk: preliminary x of every node relative to its siblings.
+    for v in order:
+        kids = children[v]
+        if kids:
+            total_shift = total_change = 0.0
+            for w in reversed(kids):
+                prelim[w] += total_shift
+                mod[w] += total_shift
+                total_change += change[w]
+                total_shift += shift[w] + total_change
+            midpoint = (prelim[kids[0]] + prelim[kids[-1]]) / 2.0
+        p = parent[v]
+        if p != -1 and number[v] > 0:
+            left = children[p][number[v] - 1]
+            prelim[v] = prelim[left] + distance(left, v)
+            if kids:
+                mod[v] = prelim[v] - midpoint
+            default_ancestor[p] = apportion(v, default_ancestor[p])
+        else:
+            prelim[v] = midpoint if kids else 0.0
+            if p != -1:
+                default_ancestor[p] = v
+
+    # Second walk: absolute x by summing the modifiers of the ancestors.
+    x = [0.0] * count
+    depth = [0] * count
+    if not order:
+        return x, depth
+    root = order[-1]
+    stack = [(root, 0.0, 0)]
+    while stack:
+        v, m, d = stack.pop()
+        x[v] = prelim[v] + m
+        depth[v] = d
+        m += mod[v]
+        for w in children[v]:
+            stack.append((w, m, d + 1))
+    return x, depth
+
+
+class SVGRenderer(ASTVisualizer):
+    """
+    Draws the tree ASTVisualizer describes, with the same labels, as SVG.
+    The layout is tidy_layout's and takes time linear in the number of nodes.
+    """
+
+    CHAR_WIDTH = 7.2
+    NODE_HEIGHT = 20.0
+    LEVEL_HEIGHT = 50.0
+    MARGIN = 10.0
 
-    def visit_Assign(self, node):
-        s = '  node{} [label="{}"]\n'.format(self.ncount, node.op.value)
-        self.dot_body.append(s)
-        node._num = self.ncount
-        self.ncount += 1
+    def __init__(self, parser):
+        super().__init__(parser)
+        self.labels = []
+        self.children = []
+        self.order = []
 
-        self.visit(node.left)
-        self.visit(node.right)
+    def add_node(self, node, label):
+        node._num = len(self.labels)
+        self.labels.append(str(label))
+        self.children.append(None)
 
-        for child_node in (node.left, node.right):
-            s = "  node{} -> node{}\n".format(node._num, child_node._num)
-            self.dot_body.append(s)
+    def generic_leave(self, node, results):
+        self.children[node._num] = [child._num for child in iter_child_nodes(node)]
+        self.order.append(node._num)
 
-    def visit_Var(self, node):
-        s = '  node{} [label="{}"]\n'.format(self.ncount, node.value)
-        self.dot_body.append(s)
-        node._num = self.ncount
-        self.ncount += 1
-
-    def visit_NoOp(self, node):
-        s = '  node{} [label="NoOp"]\n'.format(self.ncount)
-        self.dot_body.append(s)
-        node._num = self.ncount
-        self.ncount += 1
+    def node_width(self, label):
+        return max(self.NODE_HEIGHT, len(label) * self.CHAR_WIDTH + 10.0)
 
-    def gendot(self):
+    def gensvg(self, out):
+        """Write the SVG for the parsed program to the text file `out`"""
         tree = self.parser.parse()
-        self.visit(tree)
-        return "".join(self.dot_header + self.dot_body + self.dot_footer)
+        self.walk(tree)
+        labels = self.labels
+        widths = [self.node_width(label) for label in labels]
+        xs, depths = tidy_layout(self.children, self.order, widths)
+
+        half_height = self.NODE_HEIGHT / 2.0
+        left = min(x - w / 2.0 for x, w in zip(xs, widths)) - self.MARGIN
+        right = max(x + w / 2.0 for x, w in zip(xs, widths)) + self.MARGIN
+        xs = [x - left for x in xs]
+        ys = [self.MARGIN + half_height + d * self.LEVEL_HEIGHT for d in depths]
+        height = max(ys) + half_height + self.MARGIN
+
+        out.write(
+            '<svg xmlns="http://www.w3.org/2000/svg" width="{:.0f}" height="{:.0f}" '
+            'font-family="Courier" font-size="12" text-anchor="middle">\n'.format(
+                right - left, height
+            )
+        )
+        out.write('<g stroke="black" fill="none">\n')
+        for v, kids in enumerate(self.children):
+            for w in kids:
+                out.write(
+                    '<line x1="{:.1f}" y1="{:.1f}" x2="{:.1f}" y2="{:.1f}"/>\n'.format(
+                        xs[v], ys[v] + half_height, xs[w], ys[w] - half_height
+                    )
+                )
+        for v, label in enumerate(labels):
+            out.write(
+                '<rect x="{:.1f}" y="{:.1f}" width="{:.1f}" height="{:.1f}" '
+                'rx="{:.1f}" fill="white"/>\n'.format(
+                    xs[v] - widths[v] / 2.0,
+                    ys[v] - half_height,
+                    widths[v],
+                    self.NODE_HEIGHT,
+                    half_height,
+                )
+            )
+        out.write("</g>\n")
+        for v, label in enumerate(labels):
+            out.write(
+                '<text x="{:.1f}" y="{:.1f}">{}</text>\n'.format(
+                    xs[v], ys[v] + 4.0, escape(label)
+                )
+            )
+        out.write("</svg>\n")
 
 
 def main():
     argparser = argparse.ArgumentParser(description="Generate an AST DOT file.")
     argparser.add_argument("fname", help="Pascal source file")
+    argparser.add_argument(
+        "--svg", metavar="OUT", help="draw the tree into an SVG file instead"
+    )
     args = argparser.parse_args()
     fname = args.fname
     text = open(fname, "r").read()
 
     lexer = Lexer(text)
     parser = Parser(lexer)
+    if args.svg:
+        with open(args.svg, "w") as out:
+            SVGRenderer(parser).gensvg(out)
+        return
     viz = ASTVisualizer(parser)
     content = viz.gendot()
     print(content)
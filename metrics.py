@@ -0,0 +1,341 @@
+###############################################################################
+#  Always-on metrics for the Simple Pascal Interpreter.                       #
+#                                                                             #
+#  $ python metrics.py prog.pas [--json]                                      #
+#                                                                             #
+###############################################################################
+"""
+Counters and latency histograms for lexing, parsing and evaluation, exported
+as OpenMetrics text (which Prometheus scrapes) or as a JSON snapshot.
+
+A run counts its tokens with a TokenCounter wrapped around its Lexer, which
+the Parser still pulls tokens from as it goes, so lexing is timed as part of
+the "parse" phase and a LexerError is still raised where the Parser meets
+it. Nodes and statements are plain counters of the Parser and Interpreter.
+The run's counts and phase timings are collected in a Sample, which is plain
+data so a worker process can send it back, and added to the shared metrics
+once, at the end, under the metrics' locks. The per-token and per-node cost
+is an increment, so the metrics can stay on, and concurrent runs in
+different threads are safe.
+
+    import metrics
+    interpreter = metrics.run(text)
+    print(metrics.REGISTRY.to_openmetrics())
+"""
+
+import bisect
+import contextlib
+import json
+import threading
+import time
+
+from spi import Lexer, Parser, Interpreter, LexerError
+
+# Upper bounds in seconds, from 100us to 10s.
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025)
+DEFAULT_BUCKETS += (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, labels, extra=()):
+    pairs = list(zip(labelnames, labels)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in pairs
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield self.name + "_total", _format_labels(self.labelnames, labels), value
+
+    def snapshot(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [
+            {"labels": dict(zip(self.labelnames, labels)), "value": v}
+            for labels, v in values
+        ]
+
+
+class Histogram(object):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # labels -> [per-bucket counts (not cumulative), sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def _copy(self):
+        with self._lock:
+            return sorted(
+                (labels, (list(counts), total, count))
+                for labels, (counts, total, count) in self._values.items()
+            )
+
+    def samples(self):
+        for labels, (counts, total, count) in self._copy():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = (("le", _format_value(bound)),)
+                yield self.name + "_bucket", _format_labels(
+                    self.labelnames, labels, le
+                ), cumulative
+            yield self.name + "_sum", _format_labels(self.labelnames, labels), total
+            yield self.name + "_count", _format_labels(self.labelnames, labels), count
+
+    def snapshot(self):
+        result = []
+        for labels, (counts, total, count) in self._copy():
+            cumulative = []
+            running = 0
+            for bucket_count in counts:
+                running += bucket_count
+                cumulative.append(running)
+            bounds = [_format_value(bound) for bound in self.buckets]
+            result.append(
+                {
+                    "labels": dict(zip(self.labelnames, labels)),
+                    "buckets": dict(zip(bounds, cumulative)),
+                    "sum": total,
+                    "count": count,
+                }
+            )
+        return result
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def to_openmetrics(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append("{}{} {}".format(name, labels, _format_value(value)))
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        return {
+            metric.name: {
+                "type": metric.type,
+                "help": metric.help,
+                "samples": metric.snapshot(),
+            }
+            for metric in self.metrics
+        }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+
+class TokenCounter(object):
+    """Wraps a Lexer and counts the tokens the Parser takes from it"""
+
+    def __init__(self, lexer):
+        self.lexer = lexer
+        self.count = 0
+
+    def get_next_token(self):
+        self.count += 1
+        return self.lexer.get_next_token()
+
+    def __getattr__(self, name):
+        # location(), and current_char and advance() for a recovering Parser.
+        return getattr(self.lexer, name)
+
+
+class Sample(object):
+    """What one run did: its counts, seconds per finished phase and error"""
+
+    def __init__(self):
+        self.tokens = 0
+        self.nodes = 0
+        self.statements = 0
+        self.seconds = {}
+        # (phase, kind) of the exception that ended the run, if any.
+        self.error = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            # Tokens are lexed on demand, so a LexerError can end any phase.
+            phase = "lex" if isinstance(e, LexerError) else name
+            self.error = (phase, type(e).__name__)
+            raise
+        self.seconds[name] = time.perf_counter() - start
+
+    def collect(self, lexer=None, parser=None, interpreter=None):
+        """Take the counts of a run's TokenCounter, Parser and Interpreter"""
+        if lexer is not None:
+            self.tokens = lexer.count
+        if parser is not None:
+            self.nodes = parser.nodes_built
+        if interpreter is not None:
+            self.statements = interpreter.statements
+
+    def to_dict(self):
+        return {
+            "tokens": self.tokens,
+            "nodes": self.nodes,
+            "statements": self.statements,
+            "seconds": self.seconds,
+            "error": self.error,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sample = cls()
+        sample.tokens = data["tokens"]
+        sample.nodes = data["nodes"]
+        sample.statements = data["statements"]
+        sample.seconds = data["seconds"]
+        sample.error = tuple(data["error"]) if data["error"] else None
+        return sample
+
+
+class SpiMetrics(object):
+    def __init__(self, registry=None, buckets=DEFAULT_BUCKETS):
+        self.registry = registry if registry is not None else Registry()
+        register = self.registry.register
+        self.runs = register(Counter("spi_runs", "Programs run."))
+        self.tokens = register(
+            Counter("spi_tokens_lexed", "Tokens produced by the lexer.")
+        )
+        self.nodes = register(
+            Counter("spi_ast_nodes_built", "AST nodes built by the parser.")
+        )
+        self.statements = register(
+            Counter("spi_statements_executed", "Assignment statements executed.")
+        )
+        self.errors = register(
+            Counter(
+                "spi_errors",
+                "Runs that failed, by phase and error kind.",
+                ("phase", "kind"),
+            )
+        )
+        self.latency = register(
+            Histogram(
+                "spi_phase_seconds",
+                "Wall-clock time per phase.",
+                ("phase",),
+                buckets=buckets,
+            )
+        )
+
+    def record(self, sample):
+        """Add a finished run's Sample"""
+        self.runs.inc()
+        self.tokens.inc(sample.tokens)
+        self.nodes.inc(sample.nodes)
+        self.statements.inc(sample.statements)
+        for phase, seconds in sample.seconds.items():
+            self.latency.observe(seconds, phase)
+        if sample.error is not None:
+            self.errors.inc(1, *sample.error)
+
+    def run(self, text, **interpreter_options):
+        """Parse and run `text` while recording metrics. Returns the Interpreter."""
+        sample = Sample()
+        lexer = TokenCounter(Lexer(text))
+        parser = interpreter = None
+        try:
+            with sample.phase("parse"):
+                parser = Parser(lexer)
+                tree = parser.parse()
+            with sample.phase("evaluate"):
+                interpreter = Interpreter(parser, **interpreter_options)
+                interpreter.interpret(tree)
+            return interpreter
+        finally:
+            sample.collect(lexer, parser, interpreter)
+            self.record(sample)
+
+
+REGISTRY = Registry()
+METRICS = SpiMetrics(REGISTRY)
+
+
+def run(text, **interpreter_options):
+    """Run `text` recording into the module-wide REGISTRY"""
+    return METRICS.run(text, **interpreter_options)
+
+
+def main():
+    import argparse
+
+    argparser = argparse.ArgumentParser(
+        description="Run Pascal programs and print their metrics."
+    )
+    argparser.add_argument(
+        "fnames", nargs="+", metavar="fname", help="Pascal source file"
+    )
+    argparser.add_argument("--json", action="store_true", help="print a JSON snapshot")
+    args = argparser.parse_args()
+
+    for fname in args.fnames:
+        with open(fname, "r") as f:
+            text = f.read()
+        try:
+            run(text)
+        except Exception:
+            pass
+    print(REGISTRY.to_json() if args.json else REGISTRY.to_openmetrics(), end="")
+
+
+if __name__ == "__main__":
+    main()
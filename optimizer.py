@@ -0,0 +1,331 @@
+###############################################################################
+#  AST optimization passes for the Simple Pascal Interpreter.                 #
+#                                                                             #
+#  The passes rewrite a parsed Program in place. Running the rewritten tree   #
+#  leaves GLOBAL_SCOPE exactly as running the original would.                 #
+#                                                                             #
+###############################################################################
+from spi import (
+    Interpreter,
+    Assign,
+    BinOp,
+    Compound,
+    Num,
+    UnaryOp,
+    Var,
+    INTEGER_DIV,
+    FLOAT_DIV,
+    REAL_CONST,
+)
+
+
+def iter_nodes(node):
+    """Yield `node` and every expression node below it"""
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        if isinstance(node, BinOp):
+            stack.append(node.right)
+            stack.append(node.left)
+        elif isinstance(node, UnaryOp):
+            stack.append(node.expr)
+        elif isinstance(node, Assign):
+            stack.append(node.right)
+            stack.append(node.left)
+
+
+def iter_assignments(node):
+    """Yield the Assign statements of a Compound in execution order"""
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Compound):
+            stack.extend(reversed(node.children))
+        elif isinstance(node, Assign):
+            yield node
+
+
+def read_names(expr):
+    """Return the set of variable names an expression reads"""
+    return {node.value for node in iter_nodes(expr) if isinstance(node, Var)}
+
+
+class DeadStoreReport(object):
+    def __init__(self):
+        self.assignments_removed = 0
+        self.nodes_removed = 0
+        self.declarations_removed = 0
+
+    def __str__(self):
+        return (
+            "removed {} dead assignments ({} nodes) and {} unused declarations".format(
+                self.assignments_removed, self.nodes_removed, self.declarations_removed
+            )
+        )
+
+
+class DeadStoreEliminator(object):
+    """
+    Removes assignments whose value is overwritten before it is read, and
+    VAR declarations of names the program never mentions.
+
+    The final value of every variable is observable in GLOBAL_SCOPE, so only
+    assignments followed by another assignment to the same name, with no read
+    in between, are dead. An assignment could raise when it divides (other
+    than DIV by a nonzero constant), when it reads a variable that may not be
+    assigned yet (NameError), or when it mixes in a REAL value, since Python
+    raises OverflowError converting a very large integer to float. Such an
+    assignment is never dead, and since a run it stops leaves GLOBAL_SCOPE as
+    it was before it, every assignment before it counts as read there.
+
+    Execution budgets can stop a run at any node, so a run that exceeds one
+    may leave a different GLOBAL_SCOPE behind than the unoptimized run would.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.report = DeadStoreReport()
+
+    def may_raise(self, expr, assigned, real_names):
+        for node in iter_nodes(expr):
+            if isinstance(node, BinOp) and node.op.type == FLOAT_DIV:
+                return True
+            if isinstance(node, BinOp) and node.op.type == INTEGER_DIV:
+                divisor = node.right
+                if not isinstance(divisor, Num) or divisor.value == 0:
+                    return True
+            if isinstance(node, Var) and (
+                node.value not in assigned or node.value in real_names
+            ):
+                return True
+            if isinstance(node, Num) and node.token.type == REAL_CONST:
+                return True
+        return False
+
+    def may_be_real(self, expr, real_names):
+        for node in iter_nodes(expr):
+            if isinstance(node, BinOp) and node.op.type == FLOAT_DIV:
+                return True
+            if isinstance(node, Var) and node.value in real_names:
+                return True
+            if isinstance(node, Num) and node.token.type == REAL_CONST:
+                return True
+        return False
+
+    def find_dead(self, assignments):
+        # Forward pass: which assignments could raise if evaluated.
+        assigned = set()
+        real_names = set()
+        unsafe = set()
+        for node in assignments:
+            if self.may_raise(node.right, assigned, real_names):
+                unsafe.add(id(node))
+            if self.may_be_real(node.right, real_names):
+                real_names.add(node.left.value)
+            else:
+                real_names.discard(node.left.value)
+            assigned.add(node.left.value)
+
+        # Backward pass: names that are written again before being read.
+        dead = set()
+        overwritten = set()
+        for node in reversed(assignments):
+            name = node.left.value
+            if id(node) in unsafe:
+                # If it raises, every name assigned so far is in the result.
+                overwritten.clear()
+                continue
+            if name in overwritten:
+                dead.add(id(node))
+                continue
+            overwritten.add(name)
+            overwritten.difference_update(read_names(node.right))
+        return dead
+
+    def prune(self, compound, dead):
+        children = []
+        for child in compound.children:
+            if id(child) in dead:
+                self.report.assignments_removed += 1
+                self.report.nodes_removed += sum(1 for _ in iter_nodes(child))
+                continue
+            if isinstance(child, Compound):
+                self.prune(child, dead)
+            children.append(child)
+        compound.children = children
+
+    def prune_declarations(self, block):
+        used = set()
+        for node in iter_assignments(block.compound_statement):
+            used.add(node.left.value)
+            used.update(read_names(node.right))
+        declarations = [
+            decl for decl in block.declarations if decl.var_node.value in used
+        ]
+        self.report.declarations_removed += len(block.declarations) - len(declarations)
+        block.declarations = declarations
+
+    def run(self):
+        block = self.tree.block
+        assignments = list(iter_assignments(block.compound_statement))
+        self.prune(block.compound_statement, self.find_dead(assignments))
+        self.prune_declarations(block)
+        return self.report
+
+
+def eliminate_dead_stores(tree):
+    """Remove dead assignments and unused declarations from `tree`, returning a DeadStoreReport"""
+    return DeadStoreEliminator(tree).run()
+
+
+class CSEReport(object):
+    def __init__(self):
+        self.nodes_before = 0
+        self.nodes_after = 0
+        self.redundant = 0
+        # Shared expression node -> names it reads, for CSEInterpreter.
+        self.reusable = {}
+
+    def __str__(self):
+        return (
+            "hash-consed {} expression nodes into {}; {} evaluations reusable".format(
+                self.nodes_before, self.nodes_after, self.redundant
+            )
+        )
+
+
+class CommonSubexpressionEliminator(object):
+    """
+    Hash-conses the expressions of a program into a DAG: structurally equal
+    subtrees become one shared node, keyed by node type, operator or value,
+    and the identity of the already shared children. Shared nodes keep the
+    source span of their first occurrence.
+
+    It then walks the statements in execution order to count how many
+    evaluations of shared nodes could reuse an earlier value, that is, none
+    of the names the node reads has been assigned since.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.table = {}
+        self.uses = {}
+        self.report = CSEReport()
+
+    def canonical(self, node, children):
+        if isinstance(node, BinOp):
+            left, right = children
+            key = (BinOp, node.op.type, id(left), id(right))
+        elif isinstance(node, UnaryOp):
+            (expr,) = children
+            key = (UnaryOp, node.op.type, id(expr))
+        elif isinstance(node, Num):
+            key = (Num, node.token.type, node.value)
+        else:
+            key = (Var, node.value)
+
+        canon = self.table.get(key)
+        if canon is None:
+            if isinstance(node, BinOp):
+                node.left, node.right = children
+            elif isinstance(node, UnaryOp):
+                node.expr = children[0]
+            self.table[key] = canon = node
+            self.uses[canon] = 0
+        self.uses[canon] += 1
+        return canon
+
+    def intern(self, root):
+        """Return the shared node for the expression `root`"""
+        stack = [(root, False)]
+        results = []
+        while stack:
+            node, expanded = stack.pop()
+            if isinstance(node, BinOp):
+                if not expanded:
+                    stack.append((node, True))
+                    stack.append((node.right, False))
+                    stack.append((node.left, False))
+                    continue
+                right = results.pop()
+                left = results.pop()
+                children = (left, right)
+            elif isinstance(node, UnaryOp):
+                if not expanded:
+                    stack.append((node, True))
+                    stack.append((node.expr, False))
+                    continue
+                children = (results.pop(),)
+            else:
+                children = ()
+            self.report.nodes_before += 1
+            results.append(self.canonical(node, children))
+        return results[0]
+
+    def count_redundant(self, assignments):
+        reusable = self.report.reusable
+        available = set()
+        dependents = {}
+        for assignment in assignments:
+            stack = [assignment.right]
+            while stack:
+                node = stack.pop()
+                if node in available:
+                    self.report.redundant += 1
+                    continue
+                if node in reusable:
+                    available.add(node)
+                    for name in reusable[node]:
+                        dependents.setdefault(name, []).append(node)
+                if isinstance(node, BinOp):
+                    stack.append(node.right)
+                    stack.append(node.left)
+                elif isinstance(node, UnaryOp):
+                    stack.append(node.expr)
+            available.difference_update(dependents.pop(assignment.left.value, ()))
+
+    def run(self):
+        assignments = list(iter_assignments(self.tree.block.compound_statement))
+        for assignment in assignments:
+            assignment.right = self.intern(assignment.right)
+        self.report.nodes_after = len(self.table)
+        for node, uses in self.uses.items():
+            if uses > 1 and isinstance(node, BinOp):
+                self.report.reusable[node] = frozenset(read_names(node))
+        self.count_redundant(assignments)
+        return self.report
+
+
+def eliminate_common_subexpressions(tree):
+    """Hash-cons the expressions of `tree` in place, returning a CSEReport"""
+    return CommonSubexpressionEliminator(tree).run()
+
+
+class CSEInterpreter(Interpreter):
+    """
+    An Interpreter that evaluates each shared expression node of a hash-consed
+    tree once and reuses the value until one of the names it reads is assigned.
+    """
+
+    def __init__(self, parser, report, **limits):
+        super().__init__(parser, **limits)
+        self.reusable = report.reusable
+        self.cache = self.memo = {}
+        self.cached_by_name = {}
+
+    def memoize(self, node, value):
+        names = self.reusable.get(node)
+        if names is None:
+            return
+        self.cache[node] = value
+        for name in names:
+            self.cached_by_name.setdefault(name, set()).add(node)
+
+    def visit_Assign(self, node):
+        Interpreter.visit_Assign(self, node)
+        stale = self.cached_by_name.pop(node.left.value, None)
+        if stale:
+            cache = self.cache
+            for expr in stale:
+                cache.pop(expr, None)
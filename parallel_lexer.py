@@ -0,0 +1,153 @@
+###############################################################################
+#  Parallel lexing of large Pascal sources.                                   #
+#                                                                             #
+#  The text is cut into chunks at whitespace (or at the '{' of a comment)     #
+#  outside comments, where no token can straddle the cut. The chunks are      #
+#  lexed in a process pool and the token streams are joined back together    #
+#  with their offsets moved to positions in the whole text.                   #
+#                                                                             #
+###############################################################################
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from spi import Lexer, LexerError, Token, EOF, ID
+
+_WHITESPACE = re.compile(r"\s")
+
+# Sources shorter than this are lexed sequentially.
+MIN_CHUNK_SIZE = 64 * 1024
+
+
+def find_boundary(text, target, pos):
+    """
+    Return the first safe split point at or after `target`. `pos` must be a
+    position before `target` that is known to be outside a comment.
+    """
+    length = len(text)
+    while True:
+        comment = text.find("{", pos)
+        if comment == -1 or comment >= target:
+            limit = length if comment == -1 else comment
+            match = _WHITESPACE.search(text, target, limit)
+            if match is not None:
+                return match.start()
+            return limit
+        close = text.find("}", comment + 1)
+        if close == -1:
+            # An unterminated comment: leave the rest in one chunk so the
+            # error is raised exactly as the sequential lexer raises it.
+            return length
+        pos = close + 1
+        target = max(target, pos)
+
+
+def split_points(text, chunks):
+    """Return the start offsets of up to `chunks` chunks of `text`"""
+    length = len(text)
+    size = max(MIN_CHUNK_SIZE, length // max(1, chunks))
+    starts = [0]
+    while True:
+        boundary = find_boundary(text, starts[-1] + size, starts[-1])
+        if boundary >= length:
+            return starts
+        starts.append(boundary)
+
+
+def lex_chunk(chunk, offset=0):
+    """
+    Lex one chunk in a worker. Returns its tokens as (type, value, pos, end)
+    tuples, with positions moved by `offset`, and whether lexing stopped at
+    an error.
+    """
+    lexer = Lexer(chunk)
+    tokens = []
+    append = tokens.append
+    try:
+        while True:
+            token = lexer.get_next_token()
+            if token.type == EOF:
+                return tokens, False
+            append((token.type, token.value, token.pos + offset, token.end + offset))
+    except LexerError:
+        return tokens, True
+
+
+class ParallelLexer(Lexer):
+    """
+    A Lexer whose get_next_token() returns the same tokens as the sequential
+    Lexer, lexed ahead of time in a process pool.
+
+    If a chunk contains an invalid character the lexer falls back to lexing
+    sequentially from the start of that chunk, so the error, its position
+    and anything a recovering Parser does afterwards match the sequential
+    Lexer exactly.
+    """
+
+    def __init__(self, text, workers=None, executor=None):
+        super().__init__(text)
+        self.workers = workers or os.cpu_count()
+        self.executor = executor
+        self._chunks = None
+        self._results = None
+        self._tokens = iter(())
+        self._sequential = False
+
+    def _start(self):
+        starts = split_points(self.text, self.workers * 4)
+        ends = starts[1:] + [len(self.text)]
+        self._results = self._lex_chunks(starts, ends)
+        self._chunks = zip(starts, ends, self._results)
+
+    def _lex_chunks(self, starts, ends):
+        if len(starts) == 1:
+            yield lex_chunk(self.text)
+            return
+        executor = self.executor or ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            texts = (self.text[start:end] for start, end in zip(starts, ends))
+            yield from executor.map(lex_chunk, texts, starts)
+        finally:
+            if executor is not self.executor:
+                executor.shutdown(cancel_futures=True)
+
+    def _next_chunk(self):
+        """Queue the tokens of the next chunk; return False at the end of the text"""
+        for start, end, (tokens, failed) in self._chunks:
+            if failed:
+                self._results.close()
+                self._fall_back(start)
+                return False
+            if tokens:
+                # Building the Token objects is the serial part of parallel
+                # lexing, so it is kept to a single comprehension.
+                intern = sys.intern
+                self._tokens = iter(
+                    [
+                        Token(type, intern(value) if type == ID else value, pos, end)
+                        for type, value, pos, end in tokens
+                    ]
+                )
+                return True
+        return False
+
+    def _fall_back(self, pos):
+        self._sequential = True
+        self.pos = pos
+        self.current_char = self.text[pos] if pos < len(self.text) else None
+
+    def get_next_token(self):
+        if self._sequential:
+            return Lexer.get_next_token(self)
+        if self._chunks is None:
+            self._start()
+        for token in self._tokens:
+            return token
+        if self._next_chunk():
+            return next(self._tokens)
+        if self._sequential:
+            return Lexer.get_next_token(self)
+        self.pos = len(self.text)
+        self.current_char = None
+        return Token(EOF, None, self.pos, self.pos)
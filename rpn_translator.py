@@ -1,4 +1,4 @@
-from spi import Lexer, NodeVisitor, Parser
+from spi import MINUS, Lexer, NodeVisitor, Parser
 
 # Lexer -> Produces tokens from input
 # Parser -> Takes tokens and determines expressions
@@ -6,21 +6,33 @@ from spi import Lexer, NodeVisitor, Parser
 
 
 class RPN_Interpreter(NodeVisitor):
-    def __init__(self, parser):
+    def __init__(self, tree):
         self.tree = tree
 
-    def visit_BinOp(self, node):
-        left_val = self.visit(node.left)
-        right_val = self.visit(node.right)
+    def leave_BinOp(self, node, results):
+        left_val, right_val = results
         return "{left} {right} {op}".format(
             left=left_val, right=right_val, op=node.op.value
         )
 
-    def visit_Num(self, node):
+    def leave_UnaryOp(self, node, results):
+        (operand,) = results
+        # Unary plus changes nothing; a bare "-" would read as subtraction.
+        if node.op.type == MINUS:
+            return "{} neg".format(operand)
+        return operand
+
+    def leave_Num(self, node, results):
+        return node.value
+
+    def leave_Var(self, node, results):
         return node.value
 
+    def generic_leave(self, node, results):
+        raise Exception("No leave_{} method".format(type(node).__name__))
+
     def translate(self):
-        return self.visit(self.tree)
+        return self.walk(self.tree)
 
 
 if __name__ == "__main__":
@@ -28,7 +40,7 @@ if __name__ == "__main__":
         text = input("trm > ")
         lexer = Lexer(text)
         parser = Parser(lexer)
-        tree = parser.parse()
+        tree = parser.expr()
         translator = RPN_Interpreter(tree)
         translation = translator.translate()
         print(translation)
@@ -1,5 +1,9 @@
 """ Simple Pascal Interpreter"""
 
+import bisect
+import sys
+import time
+
 ################################################################
 #
 # LEXER #
@@ -31,10 +35,40 @@ COMMA = "COMMA"
 EOF = "EOF"
 
 
+class SourceError(Exception):
+    """An error at a position in the source text.
+
+    `pos` is a character offset; line and column are 1-based.
+    """
+
+    def __init__(self, message, pos=None, line=None, column=None):
+        self.message = message
+        self.pos = pos
+        self.line = line
+        self.column = column
+        if line is not None:
+            message = "{} at line {}, column {}".format(message, line, column)
+        super().__init__(message)
+
+
+class LexerError(SourceError):
+    pass
+
+
+class ParserError(SourceError):
+    pass
+
+
 class Token(object):
-    def __init__(self, type, value):
+    """A token and the [pos, end) span of its lexeme in the source text"""
+
+    __slots__ = ("type", "value", "pos", "end")
+
+    def __init__(self, type, value, pos=None, end=None):
         self.type = type
         self.value = value
+        self.pos = pos
+        self.end = end
 
     def __str__(self):
         return "Token({type}, {value})".format(type=self.type, value=repr(self.value))
@@ -53,15 +87,41 @@ RESERVED_KEYWORDS = {
     "END": Token("END", "END"),
 }
 
+# Keywords by case-folded spelling, since Pascal ignores case.
+_FOLDED_KEYWORDS = {name.casefold(): token for name, token in RESERVED_KEYWORDS.items()}
+
 
 class Lexer(object):
     def __init__(self, text):
         self.text = text
         self.pos = 0
-        self.current_char = self.text[self.pos]
-
-    def error(self):
-        raise Exception("Invalid character")
+        self.current_char = self.text[self.pos] if self.text else None
+        # Offsets at which each line starts, built on first use by location().
+        self._line_starts = None
+        # Spelling as written -> (token type, value). Identifiers are case-folded
+        # and interned, so every occurrence of a name is the same str object.
+        self.symbols = {}
+
+    def location(self, pos):
+        """Return the 1-based (line, column) of the character offset `pos`"""
+        if self._line_starts is None:
+            line_starts = [0]
+            find = self.text.find
+            i = find("\n")
+            while i != -1:
+                line_starts.append(i + 1)
+                i = find("\n", i + 1)
+            self._line_starts = line_starts
+        line = bisect.bisect_right(self._line_starts, pos)
+        return line, pos - self._line_starts[line - 1] + 1
+
+    def error(self, message=None, pos=None):
+        if pos is None:
+            pos = self.pos
+        if message is None:
+            message = "Invalid character {!r}".format(self.current_char)
+        line, column = self.location(pos)
+        raise LexerError(message, pos, line, column)
 
     def peek(self):
         """Allows us to see one character ahead without moving the pos pointer"""
@@ -83,12 +143,16 @@ class Lexer(object):
             self.advance()
 
     def skip_comment(self):
+        start = self.pos - 1
         while self.current_char != "}":
+            if self.current_char is None:
+                self.error("Unterminated comment", start)
             self.advance()
         self.advance()  # the closing curly brace!
 
     def number(self):
         """Return a multidigt integer or float consumed from the input"""
+        start = self.pos
         result = ""
         while self.current_char is not None and self.current_char.isdigit():
             result += self.current_char
@@ -102,21 +166,33 @@ class Lexer(object):
                 result += self.current_char
                 self.advance()
 
-            token = Token("REAL_CONST", float(result))
+            token = Token("REAL_CONST", float(result), start, self.pos)
         else:
-            token = Token("INTEGER_CONST", int(result))
+            token = Token("INTEGER_CONST", int(result), start, self.pos)
 
         return token
 
     def _id(self):
         """Handles identifiers and reserved keywords"""
-        result = ""
-        while self.current_char is not None and self.current_char.isalnum():
-            result += self.current_char
-            self.advance()
-
-        token = RESERVED_KEYWORDS.get(result, Token(ID, result))
-        return token
+        text = self.text
+        start = end = self.pos
+        length = len(text)
+        while end < length and (text[end].isalnum() or text[end] == "_"):
+            end += 1
+        self.pos = end
+        self.current_char = text[end] if end < length else None
+
+        lexeme = text[start:end]
+        symbol = self.symbols.get(lexeme)
+        if symbol is None:
+            folded = lexeme.casefold()
+            keyword = _FOLDED_KEYWORDS.get(folded)
+            if keyword is not None:
+                symbol = (keyword.type, keyword.value)
+            else:
+                symbol = (ID, sys.intern(folded))
+            self.symbols[lexeme] = symbol
+        return Token(symbol[0], symbol[1], start, end)
 
     def get_next_token(self):
         "Lexical Analyzer/Tokenizer/Scanner"
@@ -131,60 +207,62 @@ class Lexer(object):
                 self.skip_comment()
                 continue
 
-            if self.current_char.isalpha():
+            if self.current_char.isalpha() or self.current_char == "_":
                 return self._id()
 
             if self.current_char.isdigit():
                 return self.number()
 
+            start = self.pos
+
             if self.current_char == "+":
                 self.advance()
-                return Token(PLUS, "+")
+                return Token(PLUS, "+", start, self.pos)
 
             if self.current_char == "-":
                 self.advance()
-                return Token(MINUS, "-")
+                return Token(MINUS, "-", start, self.pos)
 
             if self.current_char == "*":
                 self.advance()
-                return Token(MUL, "*")
+                return Token(MUL, "*", start, self.pos)
 
             if self.current_char == "(":
                 self.advance()
-                return Token(LPAREN, "(")
+                return Token(LPAREN, "(", start, self.pos)
 
             if self.current_char == ")":
                 self.advance()
-                return Token(RPAREN, ")")
+                return Token(RPAREN, ")", start, self.pos)
 
             if self.current_char == ":" and self.peek() == "=":
                 self.advance()
                 self.advance()
-                return Token(ASSIGN, ":=")
+                return Token(ASSIGN, ":=", start, self.pos)
 
             if self.current_char == ";":
                 self.advance()
-                return Token(SEMI, ";")
+                return Token(SEMI, ";", start, self.pos)
 
             if self.current_char == ".":
                 self.advance()
-                return Token(DOT, ".")
+                return Token(DOT, ".", start, self.pos)
 
             if self.current_char == ":":
                 self.advance()
-                return Token(COLON, ":")
+                return Token(COLON, ":", start, self.pos)
 
             if self.current_char == ",":
                 self.advance()
-                return Token(COMMA, ",")
+                return Token(COMMA, ",", start, self.pos)
 
             if self.current_char == "/":
                 self.advance()
-                return Token(FLOAT_DIV, "/")
+                return Token(FLOAT_DIV, "/", start, self.pos)
 
             self.error()
 
-        return Token(EOF, None)
+        return Token(EOF, None, self.pos, self.pos)
 
 
 ########################################################################
@@ -195,22 +273,32 @@ class Lexer(object):
 
 
 class AST(object):
-    pass
+    # [pos, end) character span in the source, set by the Parser.
+    pos = None
+    end = None
+    # Attributes holding child nodes or lists of child nodes, in order.
+    _fields = ()
 
 
 class Program(AST):
+    _fields = ("block",)
+
     def __init__(self, name, block):
         self.name = name
         self.block = block
 
 
 class Block(AST):
+    _fields = ("declarations", "compound_statement")
+
     def __init__(self, declarations, compound_statement):
         self.declarations = declarations
         self.compound_statement = compound_statement
 
 
 class VarDecl(AST):
+    _fields = ("var_node", "type_node")
+
     def __init__(self, var_node, type_node):
         self.var_node = var_node
         self.type_node = type_node
@@ -225,6 +313,8 @@ class Type(AST):
 class Compound(AST):
     """Represents a 'BEGIN ... END' block"""
 
+    _fields = ("children",)
+
     def __init__(self):
         self.children = []
 
@@ -232,6 +322,8 @@ class Compound(AST):
 class Assign(AST):
     """Represents an assignment stagement. The left is for var, the right for expr parser method"""
 
+    _fields = ("left", "right")
+
     def __init__(self, left, op, right):
         self.left = left
         self.right = right
@@ -253,6 +345,8 @@ class NoOp(AST):
 
 
 class BinOp(AST):
+    _fields = ("left", "right")
+
     def __init__(self, left, op, right):
         self.left = left
         self.token = self.op = op
@@ -266,46 +360,133 @@ class Num(AST):
 
 
 class UnaryOp(AST):
+    _fields = ("expr",)
+
     def __init__(self, op, expr):
         self.token = self.op = op
         self.expr = expr
 
 
+class ErrorNode(AST):
+    """Stands in for a statement the recovering parser could not parse"""
+
+    def __init__(self, error):
+        self.error = error
+
+
+class _Resync(Exception):
+    """Unwinds a recovering parser to the nearest synchronization point"""
+
+
+# Tokens a recovering parser skips ahead to after a syntax error.
+SYNC_TOKENS = (SEMI, END, BEGIN, EOF)
+
+
 class Parser(object):
-    def __init__(self, lexer):
+    def __init__(self, lexer, recover=False):
+        """
+        With recover=True syntax errors do not stop the parse: they are
+        collected in self.errors, the parser skips ahead to the next
+        SEMI, END or BEGIN and the statement is replaced by an ErrorNode.
+        """
         self.lexer = lexer
-        self.current_token = self.lexer.get_next_token()
+        self.recover = recover
+        self.errors = []
+        if recover:
+            self.next_token = self._next_token_recovering
+        else:
+            self.next_token = self.lexer.get_next_token
+        self.current_token = self.next_token()
+        # End offset of the last token eaten, used to close node spans.
+        self.last_end = 0
+        self.nodes_built = 0
+
+    def _next_token_recovering(self):
+        while True:
+            try:
+                return self.lexer.get_next_token()
+            except LexerError as e:
+                self.report(e)
+                if self.lexer.current_char is not None:
+                    self.lexer.advance()
+
+    def report(self, error):
+        # A single mistake often trips several checks at the same token.
+        if not self.errors or self.errors[-1].pos != error.pos:
+            self.errors.append(error)
+
+    def diagnose(self, message):
+        """Raise a ParserError, or only record it when recovering"""
+        pos = self.current_token.pos
+        line = column = None
+        if pos is not None:
+            line, column = self.lexer.location(pos)
+        error = ParserError(message, pos, line, column)
+        if not self.recover:
+            raise error
+        self.report(error)
+        return error
 
     def error(self, message="Invalid syntax"):
-        raise Exception(message)
+        self.diagnose(message)
+        raise _Resync()
 
     def eat(self, token_type):
         if self.current_token.type == token_type:
-            self.current_token = self.lexer.get_next_token()
+            self.last_end = self.current_token.end
+            self.current_token = self.next_token()
         else:
             self.error(
-                f"Current Token: {self.current_token} - Invalid syntax \nTrying to Eat: {token_type}"
+                f"Invalid syntax: expected {token_type}, got {self.current_token}"
+            )
+
+    def expect(self, token_type):
+        """Like eat(), but a recovering parser reports a missing token and carries on"""
+        if self.current_token.type == token_type:
+            self.eat(token_type)
+        else:
+            self.diagnose(
+                f"Invalid syntax: expected {token_type}, got {self.current_token}"
             )
 
+    def synchronize(self):
+        while self.current_token.type not in SYNC_TOKENS:
+            self.current_token = self.next_token()
+
+    def span(self, node, pos):
+        """Set the span of `node` from `pos` to the end of the last token eaten"""
+        node.pos = pos
+        node.end = self.last_end
+        self.nodes_built += 1
+        return node
+
     def program(self):
         """
         program : compound statement DOT
         """
-        self.eat(PROGRAM)
-        var_node = self.variable()
-        program_name = var_node.value
-        self.eat(SEMI)
+        pos = self.current_token.pos
+        self.expect(PROGRAM)
+        program_name = None
+        if self.current_token.type == ID or not self.recover:
+            var_node = self.variable()
+            program_name = var_node.value
+        else:
+            self.diagnose(
+                f"Invalid syntax: expected program name, got {self.current_token}"
+            )
+        self.expect(SEMI)
         block_node = self.block()
         program_node = Program(program_name, block_node)
-        self.eat(DOT)
-        return program_node
+        self.expect(DOT)
+        return self.span(program_node, pos)
 
     def block(self):
         """block : declarations compound statement"""
+        pos = self.current_token.pos
         declaration_nodes = self.declarations()
         compound_statement_node = self.compound_statement()
         node = Block(declaration_nodes, compound_statement_node)
-        return node
+        return self.span(node, pos)
 
     def declarations(self):
         """declarations : VAR (variable_declaration SEMI) +
@@ -315,25 +496,35 @@ class Parser(object):
         if self.current_token.type == VAR:
             self.eat(VAR)
             while self.current_token.type == ID:
-                var_decl = self.variable_declaration()
-                declarations.extend(var_decl)
-                self.eat(SEMI)
+                if not self.recover:
+                    var_decl = self.variable_declaration()
+                    declarations.extend(var_decl)
+                    self.eat(SEMI)
+                    continue
+                try:
+                    declarations.extend(self.variable_declaration())
+                    self.expect(SEMI)
+                except _Resync:
+                    self.synchronize()
+                    if self.current_token.type == SEMI:
+                        self.eat(SEMI)
         return declarations
 
     def variable_declaration(self):
         """variable_declaration : ID (COMMA ID)* COLON type_spec"""
-        var_nodes = [Var(self.current_token)]  # first id
-        self.eat(ID)
+        var_nodes = [self.variable()]  # first id
 
         while self.current_token.type == COMMA:
             self.eat(COMMA)
-            var_nodes.append(Var(self.current_token))
-            self.eat(ID)
+            var_nodes.append(self.variable())
 
         self.eat(COLON)
 
         type_node = self.type_spec()
-        var_declarations = [VarDecl(var_node, type_node) for var_node in var_nodes]
+        var_declarations = [
+            self.span(VarDecl(var_node, type_node), var_node.pos)
+            for var_node in var_nodes
+        ]
 
         return var_declarations
 
@@ -345,21 +536,22 @@ class Parser(object):
         else:
             self.eat(REAL)
         node = Type(token)
-        return node
+        return self.span(node, token.pos)
 
     def compound_statement(self):
         """
         compound_statement: BEGIN statement_list END
         """
-        self.eat(BEGIN)
+        pos = self.current_token.pos
+        self.expect(BEGIN)
         nodes = self.statement_list()
-        self.eat(END)
+        self.expect(END)
 
         root = Compound()
         for node in nodes:
             root.children.append(node)
 
-        return root
+        return self.span(root, pos)
 
     def statement_list(self):
         """
@@ -367,14 +559,45 @@ class Parser(object):
                         | statement SEMI statement_list
         """
 
-        node = self.statement()
-        results = [node]
+        if not self.recover:
+            node = self.statement()
+            results = [node]
 
-        while self.current_token.type == SEMI:
-            self.eat(SEMI)
-            results.append(self.statement())
+            while self.current_token.type == SEMI:
+                self.eat(SEMI)
+                results.append(self.statement())
 
-        return results
+            return results
+
+        results = [self.statement_or_error()]
+        while True:
+            token_type = self.current_token.type
+            if token_type == SEMI:
+                self.eat(SEMI)
+                results.append(self.statement_or_error())
+            elif token_type in (END, DOT, EOF):
+                return results
+            else:
+                self.diagnose(
+                    f"Invalid syntax: expected SEMI, got {self.current_token}"
+                )
+                if token_type in (ID, BEGIN):
+                    results.append(self.statement_or_error())
+                else:
+                    self.synchronize()
+
+    def statement_or_error(self):
+        """A statement, or an ErrorNode after skipping to the next synchronization token"""
+        pos = self.current_token.pos
+        try:
+            return self.statement()
+        except _Resync:
+            node = ErrorNode(self.errors[-1])
+            self.synchronize()
+            node.pos = pos
+            node.end = max(pos, self.last_end)
+            self.nodes_built += 1
+            return node
 
     def statement(self):
         """
@@ -400,7 +623,7 @@ class Parser(object):
         self.eat(ASSIGN)
         right = self.expr()
         node = Assign(left, token, right)
-        return node
+        return self.span(node, left.pos)
 
     def variable(self):
         """
@@ -408,10 +631,13 @@ class Parser(object):
         """
         node = Var(self.current_token)
         self.eat(ID)
-        return node
+        return self.span(node, node.token.pos)
 
     def empty(self):
-        return NoOp()
+        node = NoOp()
+        node.pos = node.end = self.current_token.pos
+        self.nodes_built += 1
+        return node
 
     def factor(self):
         """factor: (PLUS | MINUS ) factor | INTEGER | LPAREN expr RPAREN
@@ -422,17 +648,17 @@ class Parser(object):
         if token.type == PLUS:
             self.eat(PLUS)
             node = UnaryOp(token, self.factor())
-            return node
+            return self.span(node, token.pos)
         elif token.type == MINUS:
             self.eat(MINUS)
             node = UnaryOp(token, self.factor())
-            return node
+            return self.span(node, token.pos)
         elif token.type == INTEGER_CONST:
             self.eat(INTEGER_CONST)
-            return Num(token)
+            return self.span(Num(token), token.pos)
         elif token.type == REAL_CONST:
             self.eat(REAL_CONST)
-            return Num(token)
+            return self.span(Num(token), token.pos)
         elif token.type == LPAREN:
             self.eat(LPAREN)
             node = self.expr()
@@ -444,6 +670,8 @@ class Parser(object):
 
     def term(self):
         """term: factor ((MUL | DIV) factor) *"""
+        # Not node.pos: a parenthesized factor spans its inner expression only.
+        pos = self.current_token.pos
         node = self.factor()
 
         while self.current_token.type in (MUL, INTEGER_DIV, FLOAT_DIV):
@@ -455,7 +683,7 @@ class Parser(object):
             elif token.type == FLOAT_DIV:
                 self.eat(FLOAT_DIV)
 
-            node = BinOp(left=node, op=token, right=self.factor())
+            node = self.span(BinOp(left=node, op=token, right=self.factor()), pos)
 
         return node
 
@@ -466,6 +694,7 @@ class Parser(object):
         factor: INTEGER | LPAREN expr RPAREN
         """
 
+        pos = self.current_token.pos
         node = self.term()
 
         while self.current_token.type in (PLUS, MINUS):
@@ -475,32 +704,343 @@ class Parser(object):
             elif token.type == MINUS:
                 self.eat(MINUS)
 
-            node = BinOp(left=node, op=token, right=self.term())
+            node = self.span(BinOp(left=node, op=token, right=self.term()), pos)
 
         return node
 
     def parse(self):
-        node = self.program()
+        try:
+            node = self.program()
+        except _Resync:
+            # Only a recovering parser gets here, after an error it could not
+            # synchronize on inside a statement.
+            return None
         if self.current_token.type != EOF:
-            self.error()
+            self.diagnose(f"Invalid syntax: expected EOF, got {self.current_token}")
 
         return node
 
+    def stream(self):
+        """
+        Parse a program like parse(), but instead of building it yield its
+        variable declarations and then, one at a time, the statements of its
+        outermost compound statement, each before the next is parsed. The
+        Program, Block and Compound nodes are yielded too, empty, where they
+        start; only their pos is set. Syntax errors are raised from the
+        generator where parse() would raise them.
+        """
+        if self.recover:
+            raise ValueError("Only a parser that stops at the first error can stream")
+        program = Program(None, None)
+        program.pos = self.current_token.pos
+        yield program
+        self.expect(PROGRAM)
+        program.name = self.variable().value
+        self.expect(SEMI)
+        block = Block([], None)
+        block.pos = self.current_token.pos
+        yield block
+        yield from self.declarations()
+        compound = Compound()
+        compound.pos = self.current_token.pos
+        yield compound
+        self.expect(BEGIN)
+        yield self.statement()
+        while self.current_token.type == SEMI:
+            self.eat(SEMI)
+            yield self.statement()
+        self.expect(END)
+        self.expect(DOT)
+        if self.current_token.type != EOF:
+            self.diagnose(f"Invalid syntax: expected EOF, got {self.current_token}")
+
+
+def iter_child_nodes(node):
+    """Yield the direct children of `node` in source order"""
+    for field in node._fields:
+        child = getattr(node, field)
+        if isinstance(child, list):
+            yield from child
+        else:
+            yield child
+
 
 class NodeVisitor(object):
+    """
+    visit() dispatches to visit_<NodeClass>(node), or generic_visit(node).
+
+    walk() visits a whole tree without recursion: for every node it calls
+    enter_<NodeClass>(node), walks the children, then calls
+    leave_<NodeClass>(node, results) with the list of the children's
+    results and takes its return value as the node's result. generic_enter
+    and generic_leave stand in for missing methods; by default they do
+    nothing and the result is None.
+
+    The methods are looked up once per visitor class and node class and
+    kept in per-class dispatch tables.
+    """
+
+    _visit_table = {}
+    _enter_table = {}
+    _leave_table = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._visit_table = {}
+        cls._enter_table = {}
+        cls._leave_table = {}
+
+    @classmethod
+    def _resolve(cls, table, prefix, node_class, default):
+        method = getattr(cls, prefix + node_class.__name__, None)
+        if method is None:
+            method = getattr(cls, default)
+        table[node_class] = method
+        return method
+
     def visit(self, node):
-        method_name = "visit_" + type(node).__name__
-        visitor = getattr(self, method_name, self.generic_visit)
-        return visitor(node)
+        try:
+            method = self._visit_table[type(node)]
+        except KeyError:
+            method = self._resolve(
+                self._visit_table, "visit_", type(node), "generic_visit"
+            )
+        return method(self, node)
 
     def generic_visit(self, node):
         raise Exception("No visit_{} method".format(type(node).__name__))
 
+    def generic_enter(self, node):
+        pass
+
+    def generic_leave(self, node, results):
+        return None
+
+    def walk(self, node):
+        enter_table = self._enter_table
+        leave_table = self._leave_table
+        resolve = self._resolve
+        # Entries are (node, False) to enter a node and (node, True) to leave
+        # it; `frames` holds the results collected for each open node.
+        stack = [(node, False)]
+        frames = [[]]
+        while stack:
+            node, leaving = stack.pop()
+            node_class = type(node)
+            if leaving:
+                try:
+                    leave = leave_table[node_class]
+                except KeyError:
+                    leave = resolve(leave_table, "leave_", node_class, "generic_leave")
+                results = frames.pop()
+                frames[-1].append(leave(self, node, results))
+                continue
+
+            try:
+                enter = enter_table[node_class]
+            except KeyError:
+                enter = resolve(enter_table, "enter_", node_class, "generic_enter")
+            enter(self, node)
+            stack.append((node, True))
+            frames.append([])
+            children = list(iter_child_nodes(node))
+            for child in reversed(children):
+                stack.append((child, False))
+        return frames[0][0]
+
+
+class ExecutionLimitError(SourceError):
+    """Raised when the interpreter exceeds one of its execution budgets"""
+
+    def __init__(self, limit, message, node=None, line=None, column=None):
+        self.limit = limit
+        self.node = node
+        if isinstance(node, Assign):
+            message = "{} (in assignment to {!r})".format(message, node.left.value)
+        super().__init__(message, getattr(node, "pos", None), line, column)
+
+
+class IntegerOverflowError(SourceError):
+    """Raised when a trapping IntegerModel gets a result out of its range"""
+
+
+class IntegerModel(object):
+    """
+    Fixed-width two's complement INTEGER arithmetic. Out of range results
+    "wrap" around, as most machines do, or "trap" with IntegerOverflowError,
+    as Pascal's range checking does. DIV truncates toward zero, as Pascal's
+    does, where Python's // rounds down.
+    """
+
+    WIDTHS = (16, 32, 64)
+    OVERFLOW = ("wrap", "trap")
+
+    def __init__(self, bits=32, overflow="wrap"):
+        if bits not in self.WIDTHS:
+            raise ValueError("INTEGER width must be one of {}".format(self.WIDTHS))
+        if overflow not in self.OVERFLOW:
+            raise ValueError("Overflow must be one of {}".format(self.OVERFLOW))
+        self.bits = bits
+        self.overflow = overflow
+        self.trap = overflow == "trap"
+        self.min = -(1 << (bits - 1))
+        self.max = (1 << (bits - 1)) - 1
+        self.mask = (1 << bits) - 1
+
+    def wrap(self, value):
+        return ((value - self.min) & self.mask) + self.min
+
+    def overflow_message(self, value):
+        return "Integer overflow: {} does not fit in {} bits".format(value, self.bits)
+
+    def narrow(self, value):
+        """Return the INTEGER for `value`; raise IntegerOverflowError if it traps"""
+        if self.min <= value <= self.max:
+            return value
+        if self.trap:
+            raise IntegerOverflowError(self.overflow_message(value))
+        return self.wrap(value)
+
+    def div(self, left, right):
+        """Pascal's DIV, which truncates toward zero: -7 DIV 2 is -3"""
+        quotient = abs(left) // abs(right)
+        if (left < 0) != (right < 0):
+            return -quotient
+        return quotient
+
+
+# Kinds of node Interpreter.evaluate() handles itself, by class name.
+_NUM, _VAR, _BINOP, _UNARYOP, _OTHER = range(5)
+_EXPRESSION_KINDS = {"Num": _NUM, "Var": _VAR, "BinOp": _BINOP, "UnaryOp": _UNARYOP}
+
+# Mark a node on Interpreter.evaluate()'s stack whose operands are done.
+_LEAVE_BINOP = object()
+_LEAVE_UNARYOP = object()
+
 
 class Interpreter(NodeVisitor):
-    def __init__(self, parser):
+    # Step and wall-clock budgets are checked every this many nodes. The clock
+    # is also checked before every assignment and multiplication.
+    CHECK_INTERVAL = 1024
+
+    def __init__(
+        self,
+        parser,
+        max_steps=None,
+        max_seconds=None,
+        max_int_bits=None,
+        max_scope_bytes=None,
+        int_bits=None,
+        int_overflow="wrap",
+    ):
+        """
+        max_steps:       maximum number of AST nodes evaluated
+        max_seconds:     maximum wall-clock time, including parsing
+        max_int_bits:    maximum bit length of any integer result
+        max_scope_bytes: maximum memory held by the values in GLOBAL_SCOPE
+        int_bits:        make INTEGER arithmetic 16, 32 or 64 bits wide
+                         instead of unbounded, and REAL variables floats
+        int_overflow:    "wrap" or "trap" when a fixed-width INTEGER overflows
+        """
         self.parser = parser
         self.GLOBAL_SCOPE = {}
+        self.max_steps = max_steps
+        self.max_seconds = max_seconds
+        self.max_int_bits = max_int_bits
+        self.max_scope_bytes = max_scope_bytes
+        self.integers = None
+        if int_bits is not None:
+            self.integers = IntegerModel(int_bits, int_overflow)
+        # Declared type of every variable, kept when INTEGERs are fixed-width.
+        self.declared_types = {}
+        # Values of BinOp nodes that evaluate() may reuse; see CSEInterpreter.
+        self.memo = None
+        self.reset_budget()
+
+    def reset_budget(self):
+        self.steps = 0
+        self.statements = 0
+        self.scope_bytes = 0
+        self.current_statement = None
+        self._deadline = None
+        if self.max_seconds is not None:
+            self._deadline = time.monotonic() + self.max_seconds
+        self._next_check = self._schedule_check()
+        self._limited = any(
+            limit is not None
+            for limit in (
+                self.max_steps,
+                self.max_seconds,
+                self.max_int_bits,
+                self.max_scope_bytes,
+                self.integers,
+            )
+        )
+
+    def _schedule_check(self):
+        if self.max_steps is None and self._deadline is None:
+            return float("inf")
+        next_check = self.steps + self.CHECK_INTERVAL
+        if self.max_steps is not None:
+            next_check = min(next_check, self.max_steps + 1)
+        return next_check
+
+    def _check_budget(self, node=None):
+        """Check the budgets after counting `node`, by default a node of current_statement"""
+        if node is None:
+            node = self.current_statement
+        if self.max_steps is not None and self.steps > self.max_steps:
+            self.limit_error(
+                "max_steps",
+                "Evaluated more than {} nodes".format(self.max_steps),
+                node,
+            )
+        if self._deadline is not None:
+            self._check_deadline(node)
+        self._next_check = self._schedule_check()
+
+    def _check_deadline(self, node=None):
+        if time.monotonic() > self._deadline:
+            if node is None:
+                node = self.current_statement
+            self.limit_error(
+                "max_seconds",
+                "Ran for more than {} seconds".format(self.max_seconds),
+                node,
+            )
+
+    def limit_error(self, limit, message, node):
+        line = column = None
+        if node is not None and node.pos is not None and self.parser is not None:
+            line, column = self.parser.lexer.location(node.pos)
+        raise ExecutionLimitError(limit, message, node, line, column)
+
+    def narrow(self, value, node):
+        """Fit an integer result of `node` into the INTEGER model"""
+        integers = self.integers
+        if integers.min <= value <= integers.max:
+            return value
+        if not integers.trap:
+            return integers.wrap(value)
+        line = column = None
+        if node.pos is not None and self.parser is not None:
+            line, column = self.parser.lexer.location(node.pos)
+        raise IntegerOverflowError(
+            integers.overflow_message(value), node.pos, line, column
+        )
+
+    def count_step(self, node=None):
+        """Count `node` as visited without visiting it"""
+        self.steps += 1
+        if self.steps >= self._next_check:
+            self._check_budget(node)
+
+    def visit(self, node):
+        self.steps += 1
+        if self.steps >= self._next_check:
+            # visit_Assign has not made `node` the current statement yet.
+            self._check_budget(node)
+        return NodeVisitor.visit(self, node)
 
     def visit_Program(self, node):
         self.visit(node.block)
@@ -511,32 +1051,149 @@ class Interpreter(NodeVisitor):
         self.visit(node.compound_statement)
 
     def visit_VarDecl(self, node):
-        pass
+        if self.integers is not None:
+            self.declared_types[node.var_node.value] = node.type_node.value
 
     def visit_Type(self, node):
         pass
 
-    def visit_UnaryOp(self, node):
-        op = node.op.type
-        if op == PLUS:
-            return +self.visit(node.expr)
-        elif op == MINUS:
-            return -self.visit(node.expr)
-
-    def visit_BinOp(self, node):
-        if node.op.type == PLUS:
-            return self.visit(node.left) + self.visit(node.right)
-        elif node.op.type == MINUS:
-            return self.visit(node.left) - self.visit(node.right)
-        elif node.op.type == MUL:
-            return self.visit(node.left) * self.visit(node.right)
-        elif node.op.type == INTEGER_DIV:
-            return self.visit(node.left) // self.visit(node.right)
-        elif node.op.type == FLOAT_DIV:
-            return float(self.visit(node.left)) / float(self.visit(node.right))
-
-    def visit_Num(self, node):
-        return node.value
+    # Node class -> kind for evaluate(); the same for every Interpreter class.
+    _kind_table = {}
+
+    @classmethod
+    def _resolve_kind(cls, node_class):
+        # By class name, as visit() dispatches, so arena.py's nodes work too.
+        kind = _EXPRESSION_KINDS.get(node_class.__name__, _OTHER)
+        Interpreter._kind_table[node_class] = kind
+        return kind
+
+    def evaluate(self, node):
+        """
+        Evaluate the expression `node` with an explicit stack instead of
+        recursion, so that expressions of any depth, such as a sum of 50,000
+        terms, fit in the recursion limit. Nodes are counted and checked in
+        the order visit() would reach them. When `memo` is not None, a BinOp
+        found in it is not evaluated again, and every evaluated BinOp is
+        passed to memoize().
+        """
+        kinds = self._kind_table
+        integers = self.integers
+        memo = self.memo
+        scope = self.GLOBAL_SCOPE
+        max_int_bits = self.max_int_bits
+        deadline = self._deadline
+        # A node on `stack` is to be evaluated. A node under a _LEAVE_ marker
+        # has had its operands evaluated: its operator is applied to the
+        # values on top of `values`.
+        stack = [node]
+        values = []
+        # The step count lives in a local while the loop runs.
+        steps = self.steps
+        next_check = self._next_check
+        try:
+            while stack:
+                node = stack.pop()
+                if node is _LEAVE_BINOP:
+                    node = stack.pop()
+                    right = values.pop()
+                    left = values.pop()
+                    op = node.op.type
+                    if op == PLUS:
+                        result = left + right
+                    elif op == MINUS:
+                        result = left - right
+                    elif op == MUL:
+                        # A few nodes of repeated squaring can run for minutes, long
+                        # before the next CHECK_INTERVAL, so check the clock before each.
+                        if deadline is not None:
+                            self._check_deadline()
+                        result = left * right
+                    elif op == INTEGER_DIV:
+                        if integers is not None:
+                            result = integers.div(left, right)
+                        else:
+                            result = left // right
+                    else:
+                        result = float(left) / float(right)
+                    if type(result) is int:
+                        if integers is not None:
+                            result = self.narrow(result, node)
+                        if max_int_bits is not None:
+                            if result.bit_length() > max_int_bits:
+                                self.limit_error(
+                                    "max_int_bits",
+                                    "Integer result exceeds {} bits".format(
+                                        max_int_bits
+                                    ),
+                                    self.current_statement,
+                                )
+                    if memo is not None:
+                        self.memoize(node, result)
+                    values.append(result)
+                    continue
+                if node is _LEAVE_UNARYOP:
+                    node = stack.pop()
+                    if node.op.type == PLUS:
+                        result = +values.pop()
+                    else:
+                        result = -values.pop()
+                    if integers is not None and type(result) is int:
+                        result = self.narrow(result, node)
+                    values.append(result)
+                    continue
+
+                # Enter `node`, then its left operand and so on down, without
+                # a round trip through the stack.
+                while True:
+                    steps += 1
+                    if steps >= next_check:
+                        self.steps = steps
+                        self._check_budget()
+                        next_check = self._next_check
+                    try:
+                        kind = kinds[type(node)]
+                    except KeyError:
+                        kind = self._resolve_kind(type(node))
+                    if kind == _BINOP:
+                        if memo is not None and node in memo:
+                            values.append(memo[node])
+                            break
+                        stack.append(node)
+                        stack.append(_LEAVE_BINOP)
+                        stack.append(node.right)
+                        node = node.left
+                    elif kind == _NUM:
+                        value = node.value
+                        if integers is not None and type(value) is int:
+                            value = self.narrow(value, node)
+                        values.append(value)
+                        break
+                    elif kind == _VAR:
+                        value = scope.get(node.value)
+                        if value is None:
+                            raise NameError(repr(node.value))
+                        values.append(value)
+                        break
+                    elif kind == _UNARYOP:
+                        stack.append(node)
+                        stack.append(_LEAVE_UNARYOP)
+                        node = node.expr
+                    else:
+                        values.append(NodeVisitor.visit(self, node))
+                        break
+        finally:
+            self.steps = steps
+        return values[0]
+
+    def memoize(self, node, value):
+        """Called with every BinOp evaluated while `memo` is not None"""
+
+    def visit_expression(self, node):
+        # visit() has already counted `node`, and evaluate() counts it again.
+        self.steps -= 1
+        return self.evaluate(node)
+
+    visit_UnaryOp = visit_BinOp = visit_Num = visit_Var = visit_expression
 
     def visit_Compound(self, node):
         for child in node.children:
@@ -545,38 +1202,183 @@ class Interpreter(NodeVisitor):
     def visit_NoOp(self, node):
         pass
 
+    def visit_ErrorNode(self, node):
+        raise node.error
+
     def visit_Assign(self, node):
         var_name = node.left.value
-        self.GLOBAL_SCOPE[var_name] = self.visit(node.right)
-
-    def visit_Var(self, node):
-        var_name = node.value
-        val = self.GLOBAL_SCOPE.get(var_name)
-        if val is None:
-            raise NameError(repr(var_name))
-        else:
-            return val
-
-    def interpret(self):
-        tree = self.parser.parse()
+        self.statements += 1
+        if not self._limited:
+            self.GLOBAL_SCOPE[var_name] = self.evaluate(node.right)
+            return
+
+        self.current_statement = node
+        if self._deadline is not None:
+            self._check_deadline()
+        value = self.evaluate(node.right)
+        if self.integers is not None:
+            declared_type = self.declared_types.get(var_name)
+            if declared_type == REAL:
+                value = float(value)
+            elif declared_type == INTEGER and type(value) is int:
+                value = self.narrow(value, node)
+        if self.max_scope_bytes is not None:
+            old_value = self.GLOBAL_SCOPE.get(var_name)
+            if old_value is not None:
+                self.scope_bytes -= sys.getsizeof(old_value)
+            self.scope_bytes += sys.getsizeof(value)
+            if self.scope_bytes > self.max_scope_bytes:
+                self.limit_error(
+                    "max_scope_bytes",
+                    "Scope holds more than {} bytes".format(self.max_scope_bytes),
+                    node,
+                )
+        self.GLOBAL_SCOPE[var_name] = value
+
+    def interpret(self, tree=None):
+        """Parse and run the program, or run an already parsed `tree`"""
+        self.reset_budget()
+        if tree is None:
+            tree = self.parser.parse()
         if tree is None:
             return ""
         return self.visit(tree)
 
-
-def main():
-    import sys
-
-    text = open(sys.argv[1], "r").read()
-
-    lexer = Lexer(text)
-    parser = Parser(lexer)
-    interpreter = Interpreter(parser)
-    result = interpreter.interpret()
+    def interpret_stream(self):
+        """
+        Run the program while it is parsed, one statement of its outermost
+        compound statement at a time, so only the statement being run is held
+        in memory. GLOBAL_SCOPE and the exception raised match interpret():
+        a failing statement stops execution but its error is only raised once
+        the rest of the program has parsed, and a syntax error anywhere puts
+        GLOBAL_SCOPE back as it was before the run.
+        """
+        self.reset_budget()
+        saved_scope = dict(self.GLOBAL_SCOPE)
+        statements = self.parser.stream()
+        try:
+            error = self._run_stream(statements)
+            # After a failed statement the rest of the program is only parsed.
+            for _ in statements:
+                pass
+        except Exception:
+            self.GLOBAL_SCOPE.clear()
+            self.GLOBAL_SCOPE.update(saved_scope)
+            raise
+        if error is not None:
+            raise error
+
+    def _run_stream(self, statements):
+        """Run streamed nodes until one fails and return its error; syntax errors propagate"""
+        in_compound = False
+        for node in statements:
+            try:
+                if in_compound or isinstance(node, VarDecl):
+                    self.visit(node)
+                else:
+                    # The empty Program, Block and outermost Compound nodes.
+                    in_compound = isinstance(node, Compound)
+                    self.count_step(node)
+            except Exception as e:
+                return e
+        return None
+
+
+def main(argv=None, recorder=None):
+    """
+    Run spi.py with the command line `argv`. A `recorder`, such as a
+    metrics.SpiMetrics, is given the metrics.Sample of the run.
+    """
+    import argparse
+
+    from metrics import Sample, SpiMetrics, TokenCounter
+
+    argparser = argparse.ArgumentParser(
+        description="Run a Pascal program and print its variables."
+    )
+    argparser.add_argument("fname", help="Pascal source file")
+    argparser.add_argument(
+        "--optimize",
+        action="store_true",
+        help="skip dead assignments and reuse common subexpressions; reports go to stderr",
+    )
+    argparser.add_argument(
+        "--int-bits",
+        type=int,
+        choices=IntegerModel.WIDTHS,
+        help="make INTEGER arithmetic fixed-width instead of unbounded",
+    )
+    argparser.add_argument(
+        "--int-overflow",
+        choices=IntegerModel.OVERFLOW,
+        default="wrap",
+        help="what a fixed-width INTEGER does on overflow (default: wrap)",
+    )
+    argparser.add_argument(
+        "--stream",
+        action="store_true",
+        help="run each statement as soon as it is parsed",
+    )
+    argparser.add_argument(
+        "--metrics",
+        action="store_true",
+        help="print the run's metrics to stderr in OpenMetrics text format",
+    )
+    args = argparser.parse_args(argv)
+    if args.optimize and args.stream:
+        argparser.error("--optimize needs the whole program and cannot --stream")
+    if args.optimize and args.int_bits is not None and args.int_overflow == "trap":
+        # Dead store elimination would drop assignments that could trap.
+        argparser.error("--optimize cannot be combined with --int-overflow trap")
+    options = {"int_bits": args.int_bits, "int_overflow": args.int_overflow}
+    text = open(args.fname, "r").read()
+
+    sample = Sample()
+    lexer = TokenCounter(Lexer(text))
+    parser = interpreter = None
+    try:
+        if args.stream:
+            with sample.phase("stream"):
+                parser = Parser(lexer)
+                interpreter = Interpreter(parser, **options)
+                interpreter.interpret_stream()
+        else:
+            with sample.phase("parse"):
+                parser = Parser(lexer)
+                tree = parser.parse()
+            if args.optimize:
+                from optimizer import (
+                    CSEInterpreter,
+                    eliminate_common_subexpressions,
+                    eliminate_dead_stores,
+                )
+
+                with sample.phase("optimize"):
+                    print(eliminate_dead_stores(tree), file=sys.stderr)
+                    report = eliminate_common_subexpressions(tree)
+                    print(report, file=sys.stderr)
+            with sample.phase("evaluate"):
+                if args.optimize:
+                    interpreter = CSEInterpreter(parser, report, **options)
+                else:
+                    interpreter = Interpreter(parser, **options)
+                interpreter.interpret(tree)
+    finally:
+        sample.collect(lexer, parser, interpreter)
+        if recorder is not None:
+            recorder.record(sample)
+        if args.metrics:
+            run_metrics = SpiMetrics()
+            run_metrics.record(sample)
+            print(run_metrics.registry.to_openmetrics(), file=sys.stderr, end="")
 
     for k, v in sorted(interpreter.GLOBAL_SCOPE.items()):
         print(f"{k} = {v}")
 
 
 if __name__ == "__main__":
-    main()
+    # Run from the imported module so that the optional passes, which import
+    # spi themselves, see the same AST classes as this script.
+    import spi
+
+    spi.main()
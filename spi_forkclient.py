@@ -0,0 +1,56 @@
+###############################################################################
+#  Thin client for spi_forkserver.py.                                         #
+#                                                                             #
+#  $ python spi_forkclient.py prog.pas [spi.py options]                       #
+#                                                                             #
+###############################################################################
+"""
+Takes the same arguments as spi.py and prints the same output with the same
+exit status, but has a running spi_forkserver.py do the work, so only this
+module's few imports are paid for on every invocation. The server's socket is
+taken from $SPI_FORKSERVER. Without a server the program is run in process.
+"""
+
+import json
+import os
+import socket
+import sys
+
+SOCKET_ENV = "SPI_FORKSERVER"
+DEFAULT_SOCKET = "/tmp/spi-forkserver.sock"
+
+
+def request(argv, path=None):
+    """Send spi.py arguments to the fork server and return its response"""
+    path = path or os.environ.get(SOCKET_ENV, DEFAULT_SOCKET)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        message = json.dumps({"argv": argv, "cwd": os.getcwd()})
+        sock.sendall(message.encode("utf-8") + b"\n")
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    return json.loads(b"".join(chunks))
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    try:
+        response = request(argv)
+    except (FileNotFoundError, ConnectionRefusedError):
+        import spi
+
+        sys.argv[0] = "spi.py"
+        spi.main(argv)
+        return 0
+    sys.stdout.write(response["stdout"])
+    sys.stderr.write(response["stderr"])
+    return response["status"]
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,306 @@
+###############################################################################
+#  Pre-forked worker server for the Simple Pascal Interpreter.                #
+#                                                                             #
+#  Start it with   $ python spi_forkserver.py --socket /tmp/spi.sock          #
+#  and run         $ SPI_FORKSERVER=/tmp/spi.sock \                           #
+#                        python spi_forkclient.py prog.pas                    #
+#                                                                             #
+###############################################################################
+"""
+Running `python spi.py prog.pas` spends most of its time starting Python
+and importing modules. This server pays for that once: the parent imports
+spi and the optional passes, runs a small program through them so their
+dispatch tables are built, freezes what it has allocated out of the garbage
+collector's reach (so the workers' copy-on-write pages stay shared) and then
+forks the workers. Every worker accepts connections on the shared socket.
+
+A request is one line of JSON with spi.py's arguments and the client's
+working directory:
+
+    {"argv": ["prog.pas", "--optimize"], "cwd": "/home/me"}
+
+The worker runs spi.main on them and answers with everything it printed
+and the exit status spi.py would have had, then closes the connection:
+
+    {"status": 0, "stdout": "a = 2\\n", "stderr": ""}
+
+A traceback for a failing program only lacks spi.py's own `<module>` frame.
+
+The parent replaces workers that exit, including those retired after
+--max-requests requests.
+
+Workers send the metrics.Sample of every run to the parent over a pipe, one
+line of JSON each. The parent adds them to metrics.REGISTRY and, with
+--metrics-file, rewrites that file in OpenMetrics text format after each
+batch, for Prometheus' node exporter textfile collector to pick up.
+"""
+
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import select
+import signal
+import socket
+import sys
+import traceback
+
+import metrics
+import optimizer
+import spi
+from spi_forkclient import DEFAULT_SOCKET
+
+WARMUP_PROGRAM = """
+PROGRAM Warmup;
+VAR
+    a, b : INTEGER;
+    c : REAL;
+BEGIN
+    a := 2 * (3 + 4) DIV 5;
+    b := -a - 1;
+    c := a / 3 + b;
+    b := a
+END.
+"""
+
+
+def warm_up():
+    """Run every pass once so the lazily built state exists before forking"""
+    tree = spi.Parser(spi.Lexer(WARMUP_PROGRAM)).parse()
+    spi.Interpreter(None).interpret(tree)
+    optimizer.eliminate_dead_stores(tree)
+    report = optimizer.eliminate_common_subexpressions(tree)
+    optimizer.CSEInterpreter(None, report).interpret(tree)
+
+
+class PipeRecorder(object):
+    """Sends a worker's Samples to the parent, one line of JSON per write"""
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def record(self, sample):
+        # A line this short is written atomically (it is below PIPE_BUF), so
+        # lines from different workers never interleave.
+        line = json.dumps(sample.to_dict()) + "\n"
+        os.write(self.fd, line.encode("utf-8"))
+
+
+def run(argv, cwd, recorder=None):
+    """Run spi.main(argv) in `cwd` and return the response for it"""
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    status = 0
+    saved_argv = sys.argv
+    # argparse names the program after sys.argv[0] in usage and errors.
+    sys.argv = ["spi.py"] + list(argv)
+    try:
+        os.chdir(cwd)
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            try:
+                spi.main(argv, recorder)
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    status = e.code or 0
+                else:
+                    print(e.code, file=sys.stderr)
+                    status = 1
+            except Exception:
+                # Like an uncaught exception in spi.py, without this frame.
+                exc_type, exc, tb = sys.exc_info()
+                traceback.print_exception(exc_type, exc, tb.tb_next)
+                status = 1
+    except OSError as e:
+        stderr.write("{}\n".format(e))
+        status = 1
+    finally:
+        sys.argv = saved_argv
+    return {"status": status, "stdout": stdout.getvalue(), "stderr": stderr.getvalue()}
+
+
+def handle(conn, recorder=None):
+    with conn, conn.makefile("rb") as rfile:
+        line = rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+            response = run(request["argv"], request["cwd"], recorder)
+        except (ValueError, KeyError, TypeError) as e:
+            response = {
+                "status": 2,
+                "stdout": "",
+                "stderr": "Bad request: {}\n".format(e),
+            }
+        conn.sendall(json.dumps(response).encode("utf-8"))
+
+
+def worker(listener, max_requests, recorder=None):
+    """Accept and answer requests until `max_requests` have been served"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    served = 0
+    while not max_requests or served < max_requests:
+        try:
+            conn, _ = listener.accept()
+        except InterruptedError:
+            continue
+        try:
+            handle(conn, recorder)
+        except OSError:
+            # The client went away; nothing to answer.
+            pass
+        served += 1
+
+
+class ForkServer(object):
+    def __init__(
+        self, path=DEFAULT_SOCKET, workers=None, max_requests=0, metrics_file=None
+    ):
+        self.path = path
+        self.workers = workers or os.cpu_count()
+        self.max_requests = max_requests
+        self.metrics_file = metrics_file
+        self.children = set()
+        self.listener = None
+        self.samples = None
+        self.wakeup = None
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                signal.set_wakeup_fd(-1)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                for fd in (self.samples[0],) + self.wakeup:
+                    os.close(fd)
+                recorder = PipeRecorder(self.samples[1])
+                worker(self.listener, self.max_requests, recorder)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        self.children.add(pid)
+
+    def reap(self):
+        """Replace every worker that has exited"""
+        while self.children:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                return
+            self.children.discard(pid)
+            self.spawn()
+
+    def collect(self, pending):
+        """Record the complete sample lines read from the workers' pipe"""
+        try:
+            data = os.read(self.samples[0], 65536)
+        except BlockingIOError:
+            return pending
+        *lines, pending = (pending + data).split(b"\n")
+        for line in lines:
+            metrics.METRICS.record(metrics.Sample.from_dict(json.loads(line)))
+        if lines and self.metrics_file:
+            temporary = self.metrics_file + ".tmp"
+            with open(temporary, "w") as f:
+                f.write(metrics.REGISTRY.to_openmetrics())
+            os.replace(temporary, self.metrics_file)
+        return pending
+
+    def serve(self):
+        warm_up()
+        gc.collect()
+        gc.freeze()
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen(128)
+
+        self.samples = os.pipe()
+        os.set_blocking(self.samples[0], False)
+        # SIGCHLD writes to this pipe, so one select() waits for both.
+        self.wakeup = os.pipe()
+        for fd in self.wakeup:
+            os.set_blocking(fd, False)
+        signal.set_wakeup_fd(self.wakeup[1])
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            for _ in range(self.workers):
+                self.spawn()
+            pending = b""
+            while True:
+                readable, _, _ = select.select(
+                    [self.samples[0], self.wakeup[0]], [], []
+                )
+                if self.wakeup[0] in readable:
+                    while True:
+                        try:
+                            os.read(self.wakeup[0], 4096)
+                        except BlockingIOError:
+                            break
+                    self.reap()
+                if self.samples[0] in readable:
+                    pending = self.collect(pending)
+        finally:
+            self.close()
+
+    def close(self):
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in self.children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        self.children.clear()
+        if self.wakeup is not None:
+            signal.set_wakeup_fd(-1)
+            for fd in self.wakeup + self.samples:
+                os.close(fd)
+            self.wakeup = self.samples = None
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Serve spi.py runs from pre-forked worker processes."
+    )
+    argparser.add_argument("--socket", default=DEFAULT_SOCKET, help="Unix socket path")
+    argparser.add_argument("--workers", type=int, default=os.cpu_count())
+    argparser.add_argument(
+        "--max-requests",
+        type=int,
+        default=0,
+        help="replace a worker after this many requests (default: never)",
+    )
+    argparser.add_argument(
+        "--metrics-file",
+        metavar="PATH",
+        help="keep this file updated with the workers' metrics in OpenMetrics format",
+    )
+    args = argparser.parse_args()
+
+    server = ForkServer(args.socket, args.workers, args.max_requests, args.metrics_file)
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
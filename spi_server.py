@@ -0,0 +1,376 @@
+###############################################################################
+#  asyncio evaluation server for the Simple Pascal Interpreter.               #
+#                                                                             #
+#  Start it with   $ python spi_server.py --tcp 127.0.0.1:8765                #
+#            or    $ python spi_server.py --unix /tmp/spi.sock                #
+#                                                                             #
+###############################################################################
+"""
+Every request is a JSON object:
+
+    {"id": 1, "mode": "program", "source": "PROGRAM p; BEGIN a := 1 END."}
+    {"id": 2, "mode": "expr", "source": "2 * (3 + 4)"}
+
+and every response carries the same id:
+
+    {"id": 1, "ok": true, "scope": {"a": 1}}
+    {"id": 2, "ok": true, "value": 14}
+    {"id": 3, "ok": false, "error": "NameError", "message": "'b'"}
+
+The server records metrics (see metrics.py) for every evaluation, and a
+request with mode "metrics" returns them without touching the pool, as
+OpenMetrics text or, with "format": "json", as a JSON snapshot:
+
+    {"id": 4, "mode": "metrics"}
+    {"id": 4, "ok": true, "metrics": "# HELP spi_runs Programs run.\\n..."}
+
+With --framing line each message is one line of JSON. With --framing length
+each message is a 4 byte big-endian length followed by that many bytes of JSON.
+Either way a message may be up to 16 MiB; a larger one is skipped and answered
+with an error.
+
+A connection may pipeline requests: they are evaluated concurrently in a
+process pool and the responses are written back in the order the requests
+arrived. Once --max-inflight requests of a connection are pending the server
+stops reading from it, so a fast client is slowed down by TCP instead of
+growing the server's memory.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from metrics import METRICS, Sample, TokenCounter
+from spi import Lexer, Parser, Interpreter, ExecutionLimitError, SourceError, EOF
+
+LENGTH_PREFIX = struct.Struct(">I")
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+# One multiplication of integers this size takes milliseconds, not minutes.
+DEFAULT_MAX_INT_BITS = 1 << 20
+
+
+def error_response(error, message):
+    return {"ok": False, "error": error, "message": message}
+
+
+def evaluate(source, mode="program", limits=None):
+    """Evaluate `source` and return the response body. Runs in a worker process.
+
+    `limits` are keyword arguments for the Interpreter's execution budgets.
+    """
+    return evaluate_measured(source, mode, limits)[0]
+
+
+def evaluate_measured(source, mode="program", limits=None):
+    """Like evaluate(), but return the response and the run's metrics.Sample"""
+    if mode not in ("program", "expr"):
+        return error_response("ValueError", f"Unknown mode {mode!r}"), None
+    sample = Sample()
+    lexer = TokenCounter(Lexer(source))
+    parser = interpreter = None
+    try:
+        with sample.phase("parse"):
+            parser = Parser(lexer)
+            if mode == "program":
+                tree = parser.parse()
+            else:
+                tree = parser.expr()
+                if parser.current_token.type != EOF:
+                    parser.error()
+        with sample.phase("evaluate"):
+            interpreter = Interpreter(parser, **(limits or {}))
+            if mode == "program":
+                interpreter.interpret(tree)
+                response = {"ok": True, "scope": interpreter.GLOBAL_SCOPE}
+            else:
+                response = {"ok": True, "value": interpreter.visit(tree)}
+    except SourceError as e:
+        response = {"ok": False, "error": type(e).__name__, "message": str(e)}
+        response.update(line=e.line, column=e.column)
+        if isinstance(e, ExecutionLimitError):
+            response["limit"] = e.limit
+    except Exception as e:
+        response = {"ok": False, "error": type(e).__name__, "message": str(e)}
+    sample.collect(lexer, parser, interpreter)
+    return response, sample
+
+
+class MessageTooLarge(ValueError):
+    """Raised by a framing after it has skipped a message over MAX_MESSAGE_SIZE"""
+
+
+class LineFraming(object):
+    """One JSON document per line"""
+
+    async def read(self, reader):
+        # The server's stream limit is MAX_MESSAGE_SIZE, so longer lines overrun.
+        try:
+            return await reader.readuntil(b"\n")
+        except asyncio.IncompleteReadError as e:
+            return e.partial or None
+        except asyncio.LimitOverrunError as e:
+            consumed = e.consumed
+        while True:
+            await reader.readexactly(consumed)
+            try:
+                await reader.readuntil(b"\n")
+                break
+            except asyncio.IncompleteReadError:
+                break
+            except asyncio.LimitOverrunError as e:
+                consumed = e.consumed
+        raise MessageTooLarge(f"Message exceeds {MAX_MESSAGE_SIZE} bytes")
+
+    def write(self, writer, payload):
+        writer.write(payload + b"\n")
+
+
+class LengthFraming(object):
+    """A 4 byte big-endian length followed by the JSON document"""
+
+    async def read(self, reader):
+        try:
+            header = await reader.readexactly(LENGTH_PREFIX.size)
+        except asyncio.IncompleteReadError:
+            return None
+        (size,) = LENGTH_PREFIX.unpack(header)
+        if size > MAX_MESSAGE_SIZE:
+            remaining = size
+            while remaining > 0:
+                chunk = await reader.read(min(remaining, 65536))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+            raise MessageTooLarge(f"Message of {size} bytes exceeds {MAX_MESSAGE_SIZE}")
+        return await reader.readexactly(size)
+
+    def write(self, writer, payload):
+        writer.write(LENGTH_PREFIX.pack(len(payload)) + payload)
+
+
+FRAMINGS = {"line": LineFraming, "length": LengthFraming}
+
+
+class EvaluationServer(object):
+    def __init__(
+        self,
+        workers=None,
+        framing="line",
+        timeout=5.0,
+        max_inflight=64,
+        limits=None,
+        metrics=METRICS,
+    ):
+        self.workers = workers
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.framing = FRAMINGS[framing]()
+        self.timeout = timeout
+        self.max_inflight = max_inflight
+        # The worker enforces the timeout itself as well. It checks the clock
+        # between operations, so with max_int_bits bounding the cost of each
+        # one a runaway program usually stops on its own; a worker that still
+        # overruns is killed by replace_executor().
+        self.limits = {"max_int_bits": DEFAULT_MAX_INT_BITS}
+        self.limits.update(limits or {})
+        self.limits["max_seconds"] = timeout
+        # Workers send back a Sample per request; it is recorded here.
+        self.metrics = metrics
+
+    async def submit(self, request):
+        """Run one request in the pool and build its response; never raises"""
+        if not isinstance(request, dict):
+            return dict(
+                error_response("ValueError", "A request must be a JSON object"),
+                id=None,
+            )
+        try:
+            if request.get("mode") == "metrics":
+                response = self.export_metrics(request.get("format", "openmetrics"))
+            else:
+                response = await self.run(request)
+        except Exception as e:
+            # Whatever goes wrong, such as a broken pool, the connection must
+            # still get a response for this request.
+            response = error_response(type(e).__name__, str(e))
+        response["id"] = request.get("id")
+        return response
+
+    async def run(self, request):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        # A request whose pool was replaced under it runs once more on the new one.
+        for attempt in range(2):
+            executor = self.executor
+            future = loop.run_in_executor(
+                executor,
+                evaluate_measured,
+                request.get("source", ""),
+                request.get("mode", "program"),
+                self.limits,
+            )
+            try:
+                response, sample = await asyncio.wait_for(
+                    future, deadline - loop.time()
+                )
+            except asyncio.TimeoutError:
+                self.replace_executor(executor)
+                break
+            except BrokenProcessPool:
+                self.replace_executor(executor)
+                if attempt:
+                    raise
+            else:
+                if sample is not None:
+                    self.metrics.record(sample)
+                return response
+        sample = Sample()
+        sample.error = ("evaluate", "TimeoutError")
+        self.metrics.record(sample)
+        return error_response(
+            "TimeoutError", f"Evaluation exceeded {self.timeout} seconds"
+        )
+
+    def export_metrics(self, format):
+        registry = self.metrics.registry
+        if format == "openmetrics":
+            return {"ok": True, "metrics": registry.to_openmetrics()}
+        elif format == "json":
+            return {"ok": True, "metrics": registry.snapshot()}
+        return error_response("ValueError", f"Unknown metrics format {format!r}")
+
+    def replace_executor(self, executor):
+        """
+        Kill the workers of `executor` and send new requests to a fresh pool.
+        Abandoning a timed out future leaves its worker computing, and there
+        is no way to tell which worker that is, so the whole pool goes.
+        """
+        if executor is not self.executor:
+            return
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        # ProcessPoolExecutor has no public way to stop a running task.
+        for process in list(executor._processes.values()):
+            process.kill()
+        executor.shutdown(wait=False)
+
+    async def handle(self, reader, writer):
+        """Read pipelined requests and answer them in arrival order"""
+        pending = asyncio.Queue(maxsize=self.max_inflight)
+        responder = asyncio.create_task(self.respond(pending, writer))
+        try:
+            while True:
+                try:
+                    message = await self.framing.read(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except MessageTooLarge as e:
+                    task = self.done(
+                        dict(error_response("ValueError", str(e)), id=None)
+                    )
+                    await pending.put(task)
+                    continue
+                if message is None:
+                    break
+                try:
+                    request = json.loads(message)
+                except ValueError as e:
+                    task = self.done(
+                        dict(error_response("ValueError", str(e)), id=None)
+                    )
+                else:
+                    task = asyncio.create_task(self.submit(request))
+                # Blocks while max_inflight responses are outstanding.
+                await pending.put(task)
+        finally:
+            await pending.put(None)
+            await responder
+            writer.close()
+
+    def done(self, response):
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(response)
+        return future
+
+    async def respond(self, pending, writer):
+        while True:
+            task = await pending.get()
+            if task is None:
+                return
+            response = await task
+            try:
+                payload = json.dumps(response).encode("utf-8")
+            except (TypeError, ValueError) as e:
+                # Such as an integer too long for int-to-str conversion (4300
+                # digits by default), well within max_int_bits.
+                error = error_response(type(e).__name__, str(e))
+                error["id"] = response.get("id")
+                payload = json.dumps(error).encode("utf-8")
+            self.framing.write(writer, payload)
+            try:
+                await writer.drain()
+            except ConnectionError:
+                return
+
+    async def serve(self, tcp=None, unix=None):
+        if unix is not None:
+            server = await asyncio.start_unix_server(
+                self.handle, path=unix, limit=MAX_MESSAGE_SIZE
+            )
+        else:
+            host, port = tcp.rsplit(":", 1)
+            server = await asyncio.start_server(
+                self.handle, host, int(port), limit=MAX_MESSAGE_SIZE
+            )
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Serve the Pascal interpreter over a socket."
+    )
+    address = argparser.add_mutually_exclusive_group(required=True)
+    address.add_argument("--tcp", metavar="HOST:PORT", help="listen on a TCP address")
+    address.add_argument("--unix", metavar="PATH", help="listen on a Unix socket")
+    argparser.add_argument("--framing", choices=sorted(FRAMINGS), default="line")
+    argparser.add_argument("--workers", type=int, default=os.cpu_count())
+    argparser.add_argument(
+        "--timeout", type=float, default=5.0, help="seconds per request"
+    )
+    argparser.add_argument(
+        "--max-inflight", type=int, default=64, help="pipelined requests per connection"
+    )
+    argparser.add_argument(
+        "--max-steps", type=int, help="AST nodes evaluated per request"
+    )
+    argparser.add_argument(
+        "--max-int-bits",
+        type=int,
+        default=DEFAULT_MAX_INT_BITS,
+        help="bit length of integer results (default: %(default)s)",
+    )
+    args = argparser.parse_args()
+
+    server = EvaluationServer(
+        workers=args.workers,
+        framing=args.framing,
+        timeout=args.timeout,
+        max_inflight=args.max_inflight,
+        limits={"max_steps": args.max_steps, "max_int_bits": args.max_int_bits},
+    )
+    try:
+        asyncio.run(server.serve(tcp=args.tcp, unix=args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
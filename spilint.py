@@ -0,0 +1,68 @@
+###############################################################################
+#  Syntax checker for Pascal sources - reports every error without running.  #
+#                                                                             #
+#  $ python spilint.py prog1.pas prog2.pas ...                                #
+#                                                                             #
+###############################################################################
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from spi import Lexer, Parser
+
+
+def check_source(text):
+    """Return the list of lexer and parser errors in `text`"""
+    parser = Parser(Lexer(text), recover=True)
+    parser.parse()
+    return parser.errors
+
+
+def check_file(fname):
+    """Return (fname, [(line, column, message), ...]) for one source file"""
+    try:
+        with open(fname, "r") as f:
+            text = f.read()
+    except OSError as e:
+        return fname, [(None, None, str(e))]
+    errors = check_source(text)
+    return fname, [(e.line, e.column, e.message) for e in errors]
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Report all syntax errors in Pascal sources."
+    )
+    argparser.add_argument(
+        "fnames", nargs="+", metavar="fname", help="Pascal source file"
+    )
+    argparser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="files checked in parallel",
+    )
+    args = argparser.parse_args()
+
+    if args.jobs > 1 and len(args.fnames) > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            results = list(executor.map(check_file, args.fnames, chunksize=8))
+    else:
+        results = [check_file(fname) for fname in args.fnames]
+
+    error_count = 0
+    for fname, errors in results:
+        for line, column, message in errors:
+            if line is None:
+                print(f"{fname}: error: {message}")
+            else:
+                print(f"{fname}:{line}:{column}: error: {message}")
+        error_count += len(errors)
+
+    sys.exit(1 if error_count else 0)
+
+
+if __name__ == "__main__":
+    main()
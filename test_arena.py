@@ -0,0 +1,53 @@
+"""An encoded tree must run as the spi.Interpreter runs the tree it came from"""
+
+import unittest
+
+import spi
+from arena import ArenaInterpreter, ArenaView, encode
+
+PROGRAMS = (
+    "PROGRAM p; VAR a, b : INTEGER; BEGIN a := 32767 + 1; b := -7 DIV 2 END.",
+    "PROGRAM p; VAR a, b : INTEGER; BEGIN a := -2147483647 - 1; b := a DIV -1 END.",
+    "PROGRAM p; VAR a : INTEGER; b : REAL; BEGIN a := 7 DIV -2; b := a / 2 END.",
+    "PROGRAM p; VAR a : INTEGER; BEGIN a := 2; a := a * a * a * a * a * a END.",
+)
+
+MODELS = (
+    {},
+    {"int_bits": 16},
+    {"int_bits": 32},
+    {"int_bits": 16, "int_overflow": "trap"},
+    {"int_bits": 32, "int_overflow": "trap"},
+)
+
+
+def run(interpreter):
+    """Return the GLOBAL_SCOPE and the type of the error a run ends with"""
+    try:
+        interpreter.interpret()
+    except Exception as e:
+        return interpreter.GLOBAL_SCOPE, type(e)
+    return interpreter.GLOBAL_SCOPE, None
+
+
+class ArenaInterpreterTest(unittest.TestCase):
+    def test_integer_models_match_the_interpreter(self):
+        for text in PROGRAMS:
+            view = ArenaView(encode(spi.Parser(spi.Lexer(text)).parse()))
+            for model in MODELS:
+                with self.subTest(text=text, model=model):
+                    expected = run(
+                        spi.Interpreter(spi.Parser(spi.Lexer(text)), **model)
+                    )
+                    self.assertEqual(run(ArenaInterpreter(view, **model)), expected)
+
+    def test_int_min_div_minus_one(self):
+        view = ArenaView(encode(spi.Parser(spi.Lexer(PROGRAMS[1])).parse()))
+        scope = ArenaInterpreter(view, int_bits=32).interpret()
+        self.assertEqual(scope["b"], -2147483648)
+        with self.assertRaises(spi.IntegerOverflowError):
+            ArenaInterpreter(view, int_bits=32, int_overflow="trap").interpret()
+
+
+if __name__ == "__main__":
+    unittest.main()
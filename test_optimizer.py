@@ -0,0 +1,92 @@
+"""Running an optimized tree must leave GLOBAL_SCOPE as the plain run does"""
+
+import random
+import unittest
+
+from spi import Lexer, Parser, Interpreter
+from optimizer import (
+    CSEInterpreter,
+    eliminate_common_subexpressions,
+    eliminate_dead_stores,
+)
+
+OPERATORS = ("+", "-", "*", "DIV", "/")
+
+
+def generate_expression(rng, depth, names):
+    if depth == 0 or rng.random() < 0.25:
+        choice = rng.random()
+        if choice < 0.45 and names:
+            return rng.choice(names)
+        if choice < 0.5:
+            return "{}.5".format(rng.randint(0, 9))
+        return str(rng.randint(0, 9))
+    if rng.random() < 0.1:
+        return "-({})".format(generate_expression(rng, depth - 1, names))
+    return "({} {} {})".format(
+        generate_expression(rng, depth - 1, names),
+        rng.choice(OPERATORS),
+        generate_expression(rng, depth - 1, names),
+    )
+
+
+def generate_program(rng):
+    """A short program that reuses subexpressions and sometimes fails"""
+    names = []
+    statements = []
+    for _ in range(rng.randint(1, 10)):
+        name = rng.choice("abcd")
+        # Reading "z", which is never assigned, raises NameError.
+        readable = names + ["z"] if rng.random() < 0.05 else names
+        expr = generate_expression(rng, rng.randint(0, 4), readable)
+        statements.append("{} := {}".format(name, expr))
+        if rng.random() < 0.3:
+            statements.append("{} := {}".format(rng.choice("abcd"), expr))
+        names.append(name)
+    return "PROGRAM Test; VAR a, b, c, d : INTEGER; BEGIN {} END.".format(
+        "; ".join(statements)
+    )
+
+
+def run(text, dead_stores=False, common_subexpressions=False):
+    """Return the GLOBAL_SCOPE and the type of the error a run ends with"""
+    tree = Parser(Lexer(text)).parse()
+    interpreter = Interpreter(None)
+    if dead_stores:
+        eliminate_dead_stores(tree)
+    if common_subexpressions:
+        report = eliminate_common_subexpressions(tree)
+        interpreter = CSEInterpreter(None, report)
+    try:
+        interpreter.interpret(tree)
+    except Exception as e:
+        return interpreter.GLOBAL_SCOPE, type(e)
+    return interpreter.GLOBAL_SCOPE, None
+
+
+class OptimizerEquivalenceTest(unittest.TestCase):
+    def assertEquivalent(self, text):
+        expected = run(text)
+        for passes in ((True, False), (False, True), (True, True)):
+            with self.subTest(text=text, passes=passes):
+                self.assertEqual(run(text, *passes), expected)
+
+    def test_store_before_failing_statement_is_kept(self):
+        self.assertEquivalent(
+            "PROGRAM p; VAR b, c : INTEGER; BEGIN b := 3; c := 0; b := (c / 0) END."
+        )
+
+    def test_cached_value_is_dropped_when_a_name_it_reads_changes(self):
+        self.assertEquivalent(
+            "PROGRAM p; VAR a, b, c : INTEGER; "
+            "BEGIN a := 1; b := a * 2 + 1; a := 5; c := a * 2 + 1 END."
+        )
+
+    def test_generated_programs(self):
+        rng = random.Random(0)
+        for _ in range(500):
+            self.assertEquivalent(generate_program(rng))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,461 @@
+"""Tests for the lexer, parser and interpreter in spi.py"""
+
+import os
+import random
+import unittest
+
+from spi import (
+    Lexer,
+    Parser,
+    Interpreter,
+    ExecutionLimitError,
+    IntegerModel,
+    IntegerOverflowError,
+    LexerError,
+    ParserError,
+    SourceError,
+    ErrorNode,
+    Assign,
+    EOF,
+    ID,
+    BEGIN,
+    PROGRAM,
+    VAR,
+    INTEGER_DIV,
+    INTEGER,
+    REAL,
+    PLUS,
+    MINUS,
+    MUL,
+)
+
+LIMITED_PROGRAM = """PROGRAM p;
+VAR a : INTEGER;
+BEGIN
+    a := 2;
+    a := a * a * a * a * a * a;
+    a := 1 + 2 + 3 + 4 + 5
+END."""
+
+
+def parse(text):
+    return Parser(Lexer(text)).parse()
+
+
+class ExecutionLimitTest(unittest.TestCase):
+    LIMITS = (
+        {"max_steps": 5},
+        {"max_int_bits": 3},
+        {"max_scope_bytes": 10},
+    )
+
+    def test_limits_without_a_parser(self):
+        tree = parse(LIMITED_PROGRAM)
+        for limits in self.LIMITS:
+            with self.subTest(limits=limits):
+                with self.assertRaises(ExecutionLimitError) as raised:
+                    Interpreter(None, **limits).interpret(tree)
+                self.assertIsNone(raised.exception.line)
+
+    def test_limits_with_a_parser_have_locations(self):
+        for limits in self.LIMITS:
+            with self.subTest(limits=limits):
+                parser = Parser(Lexer(LIMITED_PROGRAM))
+                with self.assertRaises(ExecutionLimitError) as raised:
+                    Interpreter(parser, **limits).interpret()
+                self.assertIsNotNone(raised.exception.line)
+
+    def test_step_limit_names_the_statement_that_exceeds_it(self):
+        text = "PROGRAM p; BEGIN a := 1; b := a+a+a+a END."
+        for max_steps, column, message in (
+            # The Compound statement is the second node counted.
+            (2, 12, "Evaluated more than 2 nodes"),
+            # b's Assign.
+            (5, 26, "Evaluated more than 5 nodes (in assignment to 'b')"),
+            # A Var in b's expression.
+            (8, 26, "Evaluated more than 8 nodes (in assignment to 'b')"),
+        ):
+            with self.subTest(max_steps=max_steps):
+                parser = Parser(Lexer(text))
+                with self.assertRaises(ExecutionLimitError) as raised:
+                    Interpreter(parser, max_steps=max_steps).interpret()
+                self.assertEqual(raised.exception.column, column)
+                self.assertTrue(str(raised.exception).startswith(message))
+
+
+class SpanTest(unittest.TestCase):
+    def spanned(self, text):
+        parser = Parser(Lexer(text))
+        node = parser.expr()
+        return text[node.pos : node.end]
+
+    def test_binop_spans_its_parenthesized_operands(self):
+        for text in (
+            "(1 + 2) * 3",
+            "3 * (1 + 2)",
+            "(1 + 2) - 3",
+            "((a)) DIV (b) + (c)",
+            "-(1 + 2) * 3",
+        ):
+            with self.subTest(text=text):
+                self.assertEqual(self.spanned(text), text)
+
+    def test_parentheses_are_not_part_of_the_inner_span(self):
+        tree = Parser(Lexer("(1 + 2) * 3")).expr()
+        self.assertEqual((tree.left.pos, tree.left.end), (1, 6))
+
+
+INT_MIN_PROGRAM = """PROGRAM p;
+VAR a, b : INTEGER;
+BEGIN
+    a := -2147483647 - 1;
+    b := a DIV -1
+END."""
+
+
+def run_fixed_width(text, int_bits=32, int_overflow="wrap"):
+    interpreter = Interpreter(
+        Parser(Lexer(text)), int_bits=int_bits, int_overflow=int_overflow
+    )
+    interpreter.interpret()
+    return interpreter.GLOBAL_SCOPE
+
+
+class IntegerModelTest(unittest.TestCase):
+    def test_wrap(self):
+        integers = IntegerModel(16, "wrap")
+        self.assertEqual(integers.narrow(32767), 32767)
+        self.assertEqual(integers.narrow(32768), -32768)
+        self.assertEqual(integers.narrow(-32769), 32767)
+        self.assertEqual(integers.narrow(65536 + 5), 5)
+
+    def test_trap(self):
+        integers = IntegerModel(16, "trap")
+        self.assertEqual(integers.narrow(-32768), -32768)
+        with self.assertRaises(IntegerOverflowError):
+            integers.narrow(32768)
+
+    def test_div_truncates_toward_zero(self):
+        integers = IntegerModel()
+        for left, right, quotient in (
+            (7, 2, 3),
+            (-7, 2, -3),
+            (7, -2, -3),
+            (-7, -2, 3),
+            (-1, 3, 0),
+        ):
+            with self.subTest(left=left, right=right):
+                self.assertEqual(integers.div(left, right), quotient)
+
+    def test_invalid_model(self):
+        with self.assertRaises(ValueError):
+            IntegerModel(8)
+        with self.assertRaises(ValueError):
+            IntegerModel(32, "saturate")
+
+    def test_int_min_div_minus_one_wraps(self):
+        scope = run_fixed_width(INT_MIN_PROGRAM)
+        self.assertEqual(scope, {"a": -2147483648, "b": -2147483648})
+
+    def test_int_min_div_minus_one_traps(self):
+        with self.assertRaises(IntegerOverflowError) as raised:
+            run_fixed_width(INT_MIN_PROGRAM, int_overflow="trap")
+        self.assertEqual(raised.exception.line, 5)
+
+    def test_program_wraps_and_truncates(self):
+        scope = run_fixed_width(
+            "PROGRAM p; VAR a, b : INTEGER; "
+            "BEGIN a := 32767 + 1; b := -7 DIV 2 END.",
+            int_bits=16,
+        )
+        self.assertEqual(scope, {"a": -32768, "b": -3})
+
+    def test_unbounded_div_rounds_down(self):
+        interpreter = Interpreter(Parser(Lexer("PROGRAM p; BEGIN b := -7 DIV 2 END.")))
+        interpreter.interpret()
+        self.assertEqual(interpreter.GLOBAL_SCOPE, {"b": -4})
+
+
+STREAMED_PROGRAMS = (
+    "PROGRAM p; VAR a : INTEGER; BEGIN a := 1; b := a + 2 END.",
+    "PROGRAM p; BEGIN BEGIN a := 1 END; b := a * 3; BEGIN END END.",
+    # Runtime errors.
+    "PROGRAM p; BEGIN a := 1; b := c; a := 2 END.",
+    "PROGRAM p; BEGIN a := 1; b := a / 0; a := 2 END.",
+    "PROGRAM p; VAR a : INTEGER; BEGIN a := 32767; a := a + 1 END.",
+    # Syntax errors, some after a statement that fails.
+    "PROGRAM p; BEGIN a := 1; b := 2 END",
+    "PROGRAM p; BEGIN a := 1; b := c; a := ) END.",
+    "PROGRAM p; VAR a INTEGER; BEGIN a := 1 END.",
+    "PROGRAM p; BEGIN a := 1 END. b",
+    # Lexer errors.
+    "PROGRAM p; BEGIN a := 1; b := a @ 2 END.",
+    "PROGRAM p; BEGIN a := 1; b := c; a := 1 ? 2 END.",
+)
+
+
+class StreamTest(unittest.TestCase):
+    def run_program(self, text, method, **options):
+        """Return GLOBAL_SCOPE and the error of a run that starts from {"z": 0}"""
+        interpreter = Interpreter(Parser(Lexer(text)), **options)
+        interpreter.GLOBAL_SCOPE["z"] = 0
+        try:
+            getattr(interpreter, method)()
+        except Exception as e:
+            error = (type(e), str(e), getattr(e, "line", None))
+            return interpreter.GLOBAL_SCOPE, error
+        return interpreter.GLOBAL_SCOPE, None
+
+    def assertStreamsLikeInterpret(self, text, **options):
+        with self.subTest(text=text, options=options):
+            self.assertEqual(
+                self.run_program(text, "interpret_stream", **options),
+                self.run_program(text, "interpret", **options),
+            )
+
+    def test_results_and_errors_match_interpret(self):
+        for text in STREAMED_PROGRAMS:
+            self.assertStreamsLikeInterpret(text)
+            self.assertStreamsLikeInterpret(text, int_bits=16, int_overflow="trap")
+
+    def test_step_limit_trips_at_the_same_node(self):
+        for max_steps in range(12):
+            self.assertStreamsLikeInterpret(STREAMED_PROGRAMS[0], max_steps=max_steps)
+            self.assertStreamsLikeInterpret(STREAMED_PROGRAMS[1], max_steps=max_steps)
+
+    def test_syntax_error_restores_the_scope(self):
+        scope, error = self.run_program(STREAMED_PROGRAMS[5], "interpret_stream")
+        self.assertEqual(scope, {"z": 0})
+        self.assertIs(error[0], ParserError)
+        scope, error = self.run_program(STREAMED_PROGRAMS[9], "interpret_stream")
+        self.assertEqual(scope, {"z": 0})
+        self.assertIs(error[0], LexerError)
+
+    def test_recovering_parser_cannot_stream(self):
+        with self.assertRaises(ValueError):
+            Interpreter(
+                Parser(Lexer(STREAMED_PROGRAMS[0]), recover=True)
+            ).interpret_stream()
+
+
+class IdentifierTest(unittest.TestCase):
+    def tokens(self, text):
+        lexer = Lexer(text)
+        tokens = []
+        token = lexer.get_next_token()
+        while token.type != EOF:
+            tokens.append(token)
+            token = lexer.get_next_token()
+        return tokens
+
+    def test_keywords_ignore_case(self):
+        for spelling in ("BEGIN", "begin", "Begin", "bEgIn"):
+            with self.subTest(spelling=spelling):
+                (token,) = self.tokens(spelling)
+                self.assertEqual(token.type, BEGIN)
+        self.assertEqual(
+            [token.type for token in self.tokens("Program vAr Div integer REAL")],
+            [PROGRAM, VAR, INTEGER_DIV, INTEGER, REAL],
+        )
+
+    def test_identifiers_are_case_folded_and_interned(self):
+        tokens = self.tokens("_number _NumBer _NUMBER")
+        self.assertEqual([token.type for token in tokens], [ID, ID, ID])
+        self.assertEqual(tokens[0].value, "_number")
+        self.assertIs(tokens[1].value, tokens[0].value)
+        self.assertIs(tokens[2].value, tokens[0].value)
+
+    def test_underscores_are_part_of_identifiers(self):
+        self.assertEqual(
+            [token.value for token in self.tokens("a_b ab _ __x x_1_")],
+            ["a_b", "ab", "_", "__x", "x_1_"],
+        )
+        # A keyword with an underscore attached is an identifier.
+        (token,) = self.tokens("begin_")
+        self.assertEqual((token.type, token.value), (ID, "begin_"))
+
+    def test_program_mixing_cases(self):
+        with open(os.path.join(os.path.dirname(__file__), "assignments.txt")) as f:
+            text = "PROGRAM Assignments;\n" + f.read()
+        interpreter = Interpreter(Parser(Lexer(text)))
+        interpreter.interpret()
+        self.assertEqual(
+            interpreter.GLOBAL_SCOPE,
+            {"_number": 2, "a": 2, "b": 25, "c": 27, "x": 11},
+        )
+
+
+BROKEN_PROGRAM = """PROGRAM p;
+BEGIN
+    a := 1 +;
+    b := 2;
+    c := * 3;
+    d := 4
+END."""
+
+
+class RecoveringParserTest(unittest.TestCase):
+    def recover(self, text):
+        parser = Parser(Lexer(text), recover=True)
+        return parser.parse(), [
+            (type(e), e.line, e.column, e.message) for e in parser.errors
+        ]
+
+    def test_reports_every_broken_statement(self):
+        tree, errors = self.recover(BROKEN_PROGRAM)
+        self.assertEqual(
+            [(line, column) for _, line, column, _ in errors], [(3, 13), (5, 10)]
+        )
+        self.assertEqual(
+            [type(node) for node in tree.block.compound_statement.children],
+            [ErrorNode, Assign, ErrorNode, Assign],
+        )
+
+    def test_missing_tokens_are_assumed(self):
+        tree, errors = self.recover("PROGRAM p; BEGIN a := 1 b := 2 END")
+        self.assertEqual(
+            [message for _, _, _, message in errors],
+            [
+                "Invalid syntax: expected SEMI, got Token(ID, 'b')",
+                "Invalid syntax: expected DOT, got Token(EOF, None)",
+            ],
+        )
+        self.assertEqual(len(tree.block.compound_statement.children), 2)
+
+    def test_lexer_errors_are_reported(self):
+        _, errors = self.recover("PROGRAM p; BEGIN a := 1 @ 2; b := 3 END.")
+        self.assertEqual(errors[0], (LexerError, 1, 25, "Invalid character '@'"))
+
+    def test_first_error_is_where_parse_raises(self):
+        for text in (
+            BROKEN_PROGRAM,
+            "PROGRAM p; BEGIN a := 1 b := 2 END",
+            "p; BEGIN a := 1 END.",
+            "PROGRAM p; VAR a INTEGER; b : REAL; BEGIN a := 1 END.",
+            "PROGRAM p; BEGIN a := (1 + ; b := 2 END.",
+            "PROGRAM p; BEGIN a := 1 ? 2 END.",
+        ):
+            with self.subTest(text=text):
+                with self.assertRaises(SourceError) as raised:
+                    parse(text)
+                e = raised.exception
+                _, errors = self.recover(text)
+                # Between statements a recovering parser expects a SEMI, where
+                # parse() only knows that the statement list has to end.
+                self.assertEqual(errors[0][:3], (type(e), e.line, e.column))
+
+    def test_valid_program_has_no_errors(self):
+        tree, errors = self.recover(LIMITED_PROGRAM)
+        self.assertEqual(errors, [])
+        self.assertIsNotNone(tree)
+
+
+class RecursiveInterpreter(Interpreter):
+    """Evaluates expressions by recursing through visit(), as a reference"""
+
+    def evaluate(self, node):
+        return self.visit(node)
+
+    def visit_BinOp(self, node):
+        left = self.visit(node.left)
+        right = self.visit(node.right)
+        op = node.op.type
+        if op == PLUS:
+            result = left + right
+        elif op == MINUS:
+            result = left - right
+        elif op == MUL:
+            result = left * right
+        elif op == INTEGER_DIV:
+            if self.integers is not None:
+                result = self.integers.div(left, right)
+            else:
+                result = left // right
+        else:
+            result = float(left) / float(right)
+        if type(result) is int and self.integers is not None:
+            result = self.narrow(result, node)
+        return result
+
+    def visit_UnaryOp(self, node):
+        result = self.visit(node.expr)
+        result = +result if node.op.type == PLUS else -result
+        if type(result) is int and self.integers is not None:
+            result = self.narrow(result, node)
+        return result
+
+    def visit_Num(self, node):
+        if type(node.value) is int and self.integers is not None:
+            return self.narrow(node.value, node)
+        return node.value
+
+    def visit_Var(self, node):
+        value = self.GLOBAL_SCOPE.get(node.value)
+        if value is None:
+            raise NameError(repr(node.value))
+        return value
+
+
+def generate_expression(rng, depth):
+    if depth == 0 or rng.random() < 0.2:
+        if rng.random() < 0.4:
+            # Reading "z", which is never assigned, raises NameError.
+            return "z" if rng.random() < 0.02 else rng.choice("ab")
+        return str(rng.choice((0, 1, 7, 255, 40000, 2.5)))
+    if rng.random() < 0.15:
+        return "{}({})".format(rng.choice("+-"), generate_expression(rng, depth - 1))
+    return "({} {} {})".format(
+        generate_expression(rng, depth - 1),
+        rng.choice(("+", "-", "*", "DIV", "/")),
+        generate_expression(rng, depth - 1),
+    )
+
+
+class EvaluateTest(unittest.TestCase):
+    def run_program(self, interpreter_class, text, **options):
+        interpreter = interpreter_class(Parser(Lexer(text)), **options)
+        try:
+            interpreter.interpret()
+        except ExecutionLimitError as e:
+            # The reference locates these at the expression node being counted
+            # rather than at its statement, see ExecutionLimitTest.
+            return interpreter.GLOBAL_SCOPE, interpreter.steps, e.limit
+        except Exception as e:
+            return interpreter.GLOBAL_SCOPE, interpreter.steps, type(e), str(e)
+        return interpreter.GLOBAL_SCOPE, interpreter.steps, None
+
+    def test_matches_recursive_evaluation(self):
+        rng = random.Random(0)
+        for _ in range(300):
+            text = "PROGRAM p; VAR a : INTEGER; b : REAL; BEGIN a := 3; b := 0.5; {} END.".format(
+                "; ".join(
+                    "{} := {}".format(rng.choice("ab"), generate_expression(rng, 5))
+                    for _ in range(rng.randint(1, 4))
+                )
+            )
+            options = rng.choice(
+                (
+                    {},
+                    {"int_bits": 16},
+                    {"int_bits": 16, "int_overflow": "trap"},
+                    {"max_steps": rng.randint(1, 80)},
+                )
+            )
+            with self.subTest(text=text, options=options):
+                self.assertEqual(
+                    self.run_program(Interpreter, text, **options),
+                    self.run_program(RecursiveInterpreter, text, **options),
+                )
+
+    def test_deep_expressions(self):
+        terms = 50000
+        text = "PROGRAM p; BEGIN a := 1; b := {}; c := {} END.".format(
+            " + ".join(["a"] * terms), " - ".join(["1"] * terms)
+        )
+        interpreter = Interpreter(Parser(Lexer(text)))
+        interpreter.interpret()
+        self.assertEqual(interpreter.GLOBAL_SCOPE, {"a": 1, "b": terms, "c": 2 - terms})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+"""Every request sent to the evaluation server gets a response"""
+
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+
+from spi_server import EvaluationServer
+
+# 2 squared 14 times has 16385 bits, more digits than int-to-str allows.
+HUGE_PROGRAM = "PROGRAM p; VAR a : INTEGER; BEGIN a := 2; {} END.".format(
+    "; ".join(["a := a * a"] * 14)
+)
+
+
+class EvaluationServerTest(unittest.TestCase):
+    def exchange(self, requests):
+        """Pipeline `requests` on one connection and return the responses"""
+
+        async def session(path):
+            server = EvaluationServer(workers=1, timeout=10.0)
+            serving = asyncio.create_task(server.serve(unix=path))
+            try:
+                while not os.path.exists(path):
+                    await asyncio.sleep(0.01)
+                reader, writer = await asyncio.open_unix_connection(path)
+                for request in requests:
+                    writer.write(json.dumps(request).encode("utf-8") + b"\n")
+                await writer.drain()
+                responses = []
+                for _ in requests:
+                    line = await asyncio.wait_for(reader.readline(), 10.0)
+                    responses.append(json.loads(line))
+                writer.close()
+                return responses
+            finally:
+                serving.cancel()
+                server.close()
+
+        with tempfile.TemporaryDirectory() as directory:
+            return asyncio.run(session(os.path.join(directory, "spi.sock")))
+
+    def test_unserializable_result_is_answered_with_an_error(self):
+        huge, after = self.exchange(
+            [
+                {"id": 1, "source": HUGE_PROGRAM},
+                {"id": 2, "mode": "expr", "source": "1 + 1"},
+            ]
+        )
+        self.assertEqual(huge["id"], 1)
+        self.assertFalse(huge["ok"])
+        self.assertEqual(huge["error"], "ValueError")
+        self.assertEqual(after, {"id": 2, "ok": True, "value": 2})
+
+    def test_malformed_requests_are_answered(self):
+        responses = self.exchange(["not an object", {"id": 2, "mode": "nope"}])
+        self.assertEqual([r["error"] for r in responses], ["ValueError", "ValueError"])
+        self.assertEqual([r["id"] for r in responses], [None, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()